@@ -34,8 +34,24 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 # stdlib
+from array import array
+import fnmatch
+import gc
+import hashlib
+import heapq
 import logging
-from time import time
+import math
+import random
+import re
+import struct
+import threading
+from time import sleep, time
+from timeit import default_timer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # project
 #from checks.metric_types import MetricTypes
@@ -61,6 +77,30 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Number of series whose context is kept ready to use, see ContextCache
+CONTEXT_CACHE_SIZE = 16384
+
+# How long a flush waits for the batch being submitted when it takes the
+# buckets to flush, see Aggregator.wait_for_batch
+BATCH_WAIT_TIMEOUT = 1
+BATCH_WAIT_STEP = .001
+
+_non_ascii = re.compile(r'[\x80-\xff]').search
+
+# A whole single value metric line, <name>:<value>|<type>[|@<rate>][|#<tags>],
+# found in a batch of lines by Aggregator.submit_packets.  Names starting with
+# an underscore are left out, so are events and service checks.
+METRIC_LINE = re.compile(
+    r'^([^_:|\r\n][^:|\r\n]*):([^:|\r\n]+)\|([^:|\r\n]+)(?:\|@([^:|\r\n]+))?(?:\|#([^|\r\n]*))?$',
+    re.MULTILINE)
+
+
+def decode_utf8(string):
+    """ Decode UTF-8 bytes, but leave pure ASCII as it is, which is cheaper """
+    if _non_ascii(string) is None:
+        return string
+    return unicode(string, 'utf-8', errors='replace')
+
 
 class Infinity(Exception):
     pass
@@ -74,8 +114,35 @@ class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    Metrics have slots rather than a __dict__, and get their name, tags,
+    hostname and device name from the context they are stored under, so that
+    each one costs little more than the values it keeps.
     """
 
+    __slots__ = ('formatter', 'context', 'last_sample_time')
+
+    def __init__(self, formatter, context):
+        self.formatter = formatter
+        self.context = context
+        self.last_sample_time = None
+
+    @property
+    def name(self):
+        return self.context[0]
+
+    @property
+    def tags(self):
+        return self.context[1] or None
+
+    @property
+    def hostname(self):
+        return self.context[2]
+
+    @property
+    def device_name(self):
+        return self.context[3]
+
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
         raise NotImplementedError()
@@ -84,18 +151,19 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the points of another metric with the same context into this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    __slots__ = ('value', 'timestamp')
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(Gauge, self).__init__(formatter, context)
         self.value = None
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
         self.timestamp = time()
 
     def sample(self, value, sample_rate, timestamp=None):
@@ -103,6 +171,12 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Last write wins
+        if other.value is not None and (self.value is None or other.last_sample_time >= self.last_sample_time):
+            self.value = other.value
+            self.last_sample_time = other.last_sample_time
+            self.timestamp = other.timestamp
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -129,6 +203,8 @@ class BucketGauge(Gauge):
 
     """
 
+    __slots__ = ()
+
     def flush(self, timestamp, interval):
         if self.value is not None:
             res = [self.formatter(
@@ -150,19 +226,21 @@ class BucketGauge(Gauge):
 class Count(Metric):
     """ A metric that tracks a count. """
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    __slots__ = ('value',)
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(Count, self).__init__(formatter, context)
         self.value = None
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.value = (self.value or 0) + value
         self.last_sample_time = time()
 
+    def merge(self, other):
+        if other.value is not None:
+            self.value = (self.value or 0) + other.value
+            self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if self.value is None:
             return []
@@ -182,16 +260,13 @@ class Count(Metric):
 
 class MonotonicCount(Metric):
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(MonotonicCount, self).__init__(formatter, context)
         self.prev_counter = None
         self.curr_counter = None
         self.count = None
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         if self.curr_counter is None:
@@ -230,19 +305,20 @@ class MonotonicCount(Metric):
 class Counter(Metric):
     """ A metric that tracks a counter value. """
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    __slots__ = ('value',)
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(Counter, self).__init__(formatter, context)
         self.value = 0
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -263,40 +339,66 @@ DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
 class Histogram(Metric):
-    """ A metric to track the distribution of a set of values. """
+    """
+    A metric to track the distribution of a set of values, exactly: they are
+    kept until the flush, in a typed array that NumPy selects from in place,
+    or without NumPy in a list, which sorts faster than the copy of an array
+    would.
+    """
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles')
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(Histogram, self).__init__(formatter, context)
         self.count = 0
-        self.samples = []
+        self.samples = array('d') if numpy is not None else []
         self.aggregates = extra_config['aggregates'] if \
             extra_config is not None and extra_config.get('aggregates') is not None \
             else DEFAULT_HISTOGRAM_AGGREGATES
         self.percentiles = extra_config['percentiles'] if \
             extra_config is not None and extra_config.get('percentiles') is not None \
             else DEFAULT_HISTOGRAM_PERCENTILES
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.count += int(1 / sample_rate)
         self.samples.append(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
+        samples = self.samples
+        length = len(samples)
+        # Indexes of the median and percentiles in the sorted samples, those
+        # below 0 wrap around as they always have
+        med_index = int(round(length/2 - 1)) % length
+        indexes = [int(round(p * length - 1)) % length for p in self.percentiles]
+
+        if numpy is not None:
+            # Selection puts just these indexes in their sorted place, in one
+            # pass rather than a full sort
+            values = numpy.frombuffer(samples, dtype=numpy.float64)
+            selected = numpy.partition(values, sorted(set([0, length - 1, med_index] + indexes)))
+            total = values.sum()
+            # Python floats rather than NumPy scalars
+            pick = selected.item
+        else:
+            # In place, the samples are reset below
+            selected = samples
+            selected.sort()
+            total = sum(selected)
+            pick = selected.__getitem__
 
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
+        min_ = pick(0)
+        max_ = pick(length - 1)
+        med = pick(med_index)
+        avg = total / float(length)
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -323,8 +425,8 @@ class Histogram(Metric):
             interval=interval) for suffix, value, metric_type in metric_aggrs
                    ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, index in zip(self.percentiles, indexes):
+            val = pick(index)
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -337,28 +439,249 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
+        self.samples = array('d') if numpy is not None else []
         self.count = 0
 
         return metrics
 
 
+# Relative accuracy of the quantiles of a QuantileSketch, and the most bins
+# it keeps, which bounds its size whatever the samples
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MAX_BINS = 2048
+
+class QuantileSketch(object):
+    """
+    A mergeable quantile sketch with a relative error guarantee: values are
+    counted in logarithmic bins, gamma times wider than the previous one, so
+    any quantile is within ``relative_accuracy`` of the exact one.  Bins are
+    only created for the values seen and, past ``max_bins``, the lowest ones
+    are collapsed together, which keeps its size fixed.  Two sketches with
+    the same settings merge by adding their bin counts.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.multiplier = 1 / math.log(self.gamma)
+        self.max_bins = max_bins
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value, weight=1):
+        if value > 0:
+            bins = self.positive
+            index = int(math.ceil(math.log(value) * self.multiplier))
+        elif value < 0:
+            bins = self.negative
+            index = int(math.ceil(math.log(-value) * self.multiplier))
+        else:
+            self.zero += weight
+            bins = None
+        if bins is not None:
+            bins[index] = bins.get(index, 0) + weight
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.count += weight
+        self.sum += value * weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def _collapse(self, bins):
+        # Fold the bins nearest to zero into the next one
+        indexes = sorted(bins)
+        excess = len(bins) - self.max_bins
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            bins[target] += bins.pop(index)
+
+    def merge(self, other):
+        for bins, other_bins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """ The value of rank q * (count - 1), for q in [0, 1] """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        value = None
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                value = -self._value(index)
+                break
+        else:
+            seen += self.zero
+            if seen > rank:
+                value = 0
+            else:
+                for index in sorted(self.positive):
+                    seen += self.positive[index]
+                    if seen > rank:
+                        value = self._value(index)
+                        break
+                else:
+                    value = self.max
+        return max(self.min, min(self.max, value))
+
+
+DEFAULT_DISTRIBUTION_PERCENTILES = [0.5, 0.99, 0.999]
+
+class Distribution(Metric):
+    """
+    A metric to track the distribution of a set of values in a QuantileSketch
+    rather than keeping them, so it takes the same memory whatever the rate
+    and merges across shards without losing accuracy.
+
+    It always reports min, max, avg, count and the
+    DEFAULT_DISTRIBUTION_PERCENTILES, the aggregates and percentiles
+    configured for histograms don't apply: distributions are meant to be
+    comparable wherever they come from.
+    """
+
+    __slots__ = ('sketch',)
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(Distribution, self).__init__(formatter, context)
+        self.sketch = QuantileSketch()
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.sketch.add(value, int(1 / sample_rate))
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def flush(self, ts, interval):
+        sketch = self.sketch
+        if not sketch.count:
+            return []
+
+        values = [
+            ('min', sketch.min, MetricTypes.GAUGE),
+            ('max', sketch.max, MetricTypes.GAUGE),
+            ('avg', sketch.sum / float(sketch.count), MetricTypes.GAUGE),
+            ('count', sketch.count / interval, MetricTypes.RATE),
+        ]
+        for p in DEFAULT_DISTRIBUTION_PERCENTILES:
+            # 0.999 is the 99_9percentile
+            name = '%spercentile' % ('%g' % (p * 100)).replace('.', '_')
+            values.append((name, sketch.quantile(p), MetricTypes.GAUGE))
+
+        # Reset our state.
+        self.sketch = QuantileSketch()
+
+        return [self.formatter(
+            hostname=self.hostname,
+            device_name=self.device_name,
+            tags=self.tags,
+            metric='%s.%s' % (self.name, suffix),
+            value=value,
+            timestamp=ts,
+            metric_type=metric_type,
+            interval=interval) for suffix, value, metric_type in values]
+
+
+class SketchHistogram(Metric):
+    """
+    A Histogram that keeps its values in a QuantileSketch rather than a list,
+    for the metrics too busy to keep and sort every sample.  Min, max, avg and
+    count are exact, the median and percentiles within the sketch's relative
+    accuracy.
+    """
+
+    __slots__ = ('count', 'sketch', 'aggregates', 'percentiles')
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(SketchHistogram, self).__init__(formatter, context)
+        self.count = 0
+        self.sketch = QuantileSketch()
+        self.aggregates = extra_config['aggregates'] if \
+            extra_config is not None and extra_config.get('aggregates') is not None \
+            else DEFAULT_HISTOGRAM_AGGREGATES
+        self.percentiles = extra_config['percentiles'] if \
+            extra_config is not None and extra_config.get('percentiles') is not None \
+            else DEFAULT_HISTOGRAM_PERCENTILES
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.sketch.add(value)
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        sketch = self.sketch
+        aggregators = [
+            ('min', sketch.min, MetricTypes.GAUGE),
+            ('max', sketch.max, MetricTypes.GAUGE),
+            ('median', sketch.quantile(0.5), MetricTypes.GAUGE),
+            ('avg', sketch.sum / float(sketch.count), MetricTypes.GAUGE),
+            ('count', self.count/interval, MetricTypes.RATE),
+        ]
+        values = [(suffix, value, metric_type)
+                  for suffix, value, metric_type in aggregators
+                  if suffix in self.aggregates]
+        for p in self.percentiles:
+            values.append(('%spercentile' % int(p * 100), sketch.quantile(p), MetricTypes.GAUGE))
+
+        # Reset our state.
+        self.sketch = QuantileSketch()
+        self.count = 0
+
+        return [self.formatter(
+            hostname=self.hostname,
+            device_name=self.device_name,
+            tags=self.tags,
+            metric='%s.%s' % (self.name, suffix),
+            value=value,
+            timestamp=ts,
+            metric_type=metric_type,
+            interval=interval) for suffix, value, metric_type in values]
+
+
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    __slots__ = ('values',)
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(Set, self).__init__(formatter, context)
         self.values = set()
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
@@ -377,17 +700,88 @@ class Set(Metric):
             self.values = set()
 
 
+# Number of index bits of the ApproximateSet hashes, each set keeps a byte
+# per index, which gives a standard error of 1.04 / sqrt(2 ** precision)
+HLL_PRECISION = 12
+_HLL_MIN_PRECISION = 4
+_HLL_MAX_PRECISION = 16
+
+_unpack_hash = struct.Struct('<Q').unpack_from
+
+class ApproximateSet(Metric):
+    """
+    A Set that estimates its number of unique elements with HyperLogLog,
+    in a fixed 2 ** precision bytes instead of keeping every element.  The
+    highest rank, first set bit of its 64 bit hash, seen by each register is
+    kept and the registers of two sets merge by keeping the highest ranks.
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(ApproximateSet, self).__init__(formatter, context)
+        precision = HLL_PRECISION
+        if extra_config is not None and extra_config.get('precision') is not None:
+            precision = min(max(int(extra_config['precision']), _HLL_MIN_PRECISION), _HLL_MAX_PRECISION)
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def sample(self, value, sample_rate, timestamp=None):
+        if not isinstance(value, str):
+            value = unicode(value).encode('utf-8')
+        hashed = _unpack_hash(hashlib.sha1(value).digest())[0]
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rest = hashed & ((1 << bits) - 1)
+        # Its length in bits, int.bit_length is new in Python 2.7
+        rank = bits - (len(bin(rest)) - 2 if rest else 0) + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.registers = bytearray(max(ranks) for ranks in zip(self.registers, other.registers))
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def estimate(self):
+        registers = self.registers
+        size = len(registers)
+        # Registers by rank, counted in C
+        counts = [registers.count(chr(rank)) for rank in xrange(66 - self.precision)]
+        total = sum(count * 2.0 ** -rank for rank, count in enumerate(counts))
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+        estimate = alpha * size * size / total
+        if estimate <= 2.5 * size and counts[0]:
+            # Linear counting is better for the small cardinalities
+            estimate = size * math.log(size / float(counts[0]))
+        return int(round(estimate))
+
+    def flush(self, timestamp, interval):
+        if self.registers.count('\x00') == len(self.registers):
+            return []
+        try:
+            return [self.formatter(
+                hostname=self.hostname,
+                device_name=self.device_name,
+                tags=self.tags,
+                metric=self.name,
+                value=self.estimate(),
+                timestamp=timestamp,
+                metric_type=MetricTypes.GAUGE,
+                interval=interval,
+            )]
+        finally:
+            self.registers = bytearray(len(self.registers))
+
+
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
-        self.name = name
-        self.tags = tags
-        self.hostname = hostname
-        self.device_name = device_name
+    __slots__ = ('samples',)
+
+    def __init__(self, formatter, context, extra_config=None):
+        super(Rate, self).__init__(formatter, context)
         self.samples = []
-        self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
         ts = time()
@@ -429,17 +823,178 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+class ContextCache(object):
+    """
+    A bounded map from the raw (name, type, tags) of a metric line to its
+    finished context and tags, so that lines of a known series skip the tag
+    sorting, magic tag extraction and deduplication.
+
+    LRU is approximated with two generations of dicts: entries go into the
+    young one, which becomes the old one when it holds half the capacity.
+    A hit in the old generation moves the entry back into the young one, so
+    whatever isn't used for a whole generation is dropped.
+    """
+
+    def __init__(self, capacity=CONTEXT_CACHE_SIZE):
+        self.generation_size = max(1, capacity // 2)
+        self.young = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.young.get(key)
+        if entry is None:
+            entry = self.old.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.put(key, entry)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if len(self.young) >= self.generation_size:
+            self.old = self.young
+            self.young = {}
+        self.young[key] = entry
+
+
+# Cached in place of a context for series dropped by the MetricFilter
+FILTERED = object()
+
+
+def _any_glob(patterns):
+    """ The match method of a single regex for a list of fnmatch patterns """
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern) for pattern in patterns)).match
+
+
+class MetricFilter(object):
+    """
+    Allow, deny and rename rules for metric names and tag keys, each kind
+    compiled into a single regex.
+
+    A name must match one of the ``allow`` patterns if there are any, and
+    none of the ``deny`` patterns.  ``rename`` is a list of (prefix,
+    replacement), the longest matching prefix is replaced.  Tags are kept or
+    dropped by their key in the same way with ``allow_tags`` and
+    ``deny_tags``, and ``rename_tags`` maps keys to new keys.  Patterns use
+    fnmatch syntax, and rules look at the names and keys as received.
+    """
+
+    def __init__(self, allow=(), deny=(), rename=(), allow_tags=(), deny_tags=(), rename_tags=()):
+        self.allow = _any_glob(allow)
+        self.deny = _any_glob(deny)
+        self.rename = None
+        self.replacements = []
+        if rename:
+            # Alternatives are tried in order, so longest prefix first
+            rename = sorted(rename, key=lambda rule: -len(rule[0]))
+            self.rename = re.compile('|'.join('(%s)' % re.escape(prefix) for prefix, _ in rename)).match
+            self.replacements = [replacement for _, replacement in rename]
+        self.allow_tags = _any_glob(allow_tags)
+        self.deny_tags = _any_glob(deny_tags)
+        self.rename_tags = dict(rename_tags)
+        self.filters_tags = bool(allow_tags or deny_tags or rename_tags)
+
+    def apply(self, name, tags):
+        """ Returns the name and tags to use, or None if the metric is dropped """
+        if self.deny is not None and self.deny(name):
+            return None
+        if self.allow is not None and not self.allow(name):
+            return None
+        if self.rename is not None:
+            match = self.rename(name)
+            if match:
+                name = self.replacements[match.lastindex - 1] + name[match.end():]
+
+        if tags and self.filters_tags:
+            kept = []
+            for tag in tags:
+                key, separator, value = tag.partition(':')
+                if self.deny_tags is not None and self.deny_tags(key):
+                    continue
+                if self.allow_tags is not None and not self.allow_tags(key):
+                    continue
+                if key in self.rename_tags:
+                    tag = self.rename_tags[key] + separator + value
+                kept.append(tag)
+            tags = tuple(sorted(kept)) or None
+        return name, tags
+
+
+class CardinalityLimiter(object):
+    """
+    Bounds the number of distinct contexts an aggregator creates between two
+    flushes, per metric name and overall, so a client putting unique ids in
+    its tags can't exhaust memory.
+
+    Samples of contexts past the limit of their metric go to the metric's
+    OVERFLOW_TAG context instead, and past the overall limit to the
+    OVERFLOW metric tagged with their type.  The number of samples diverted
+    is kept per metric name, and under OVERFLOW for the overall limit.
+    """
+    OVERFLOW = '__overflow__'
+    OVERFLOW_TAG = '__overflow__:true'
+
+    def __init__(self, max_contexts_per_metric=0, max_contexts=0):
+        self.max_contexts_per_metric = max_contexts_per_metric
+        self.max_contexts = max_contexts
+        self.contexts = set()
+        self.contexts_by_name = {}
+        self.limited = {}
+
+    def admit(self, context, tags, mtype):
+        """ Returns the context and tags to submit a sample of ``context`` to """
+        if context in self.contexts:
+            return context, tags
+        name = context[0]
+        count = self.contexts_by_name.get(name, 0)
+        if self.max_contexts_per_metric and count >= self.max_contexts_per_metric:
+            self.limited[name] = self.limited.get(name, 0) + 1
+            tags = (self.OVERFLOW_TAG,)
+            return (name, tags, context[2], context[3]), tags
+        if self.max_contexts and len(self.contexts) >= self.max_contexts:
+            # Counted as a whole, there could be any number of such names
+            self.limited[self.OVERFLOW] = self.limited.get(self.OVERFLOW, 0) + 1
+            tags = ('metric_type:%s' % mtype,)
+            return (self.OVERFLOW, tags, context[2], context[3]), tags
+        self.contexts.add(context)
+        self.contexts_by_name[name] = count + 1
+        return context, tags
+
+    def reset(self, contexts):
+        """ Start counting again from the contexts still held """
+        self.contexts = set()
+        self.contexts_by_name = {}
+        for context in contexts:
+            if context[0] != self.OVERFLOW and self.OVERFLOW_TAG not in context[1]:
+                self.admit(context, None, None)
+
+    def pop_limited(self):
+        limited = self.limited
+        self.limited = {}
+        return limited
+
+
 class Aggregator(object):
     """
     Abstract metric aggregator class.
     """
     # Types of metrics that allow strings
     ALLOW_STRINGS = ['s', ]
+    # Types whose samples may be dropped when overloaded, their counts are
+    # scaled like for client side sampling
+    SHEDDABLE_TYPES = ('h', 'ms', 'd')
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=CONTEXT_CACHE_SIZE,
+                 metric_filter=None, sketch_histograms=None, approximate_sets=None,
+                 set_precision=HLL_PRECISION):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -455,6 +1010,28 @@ class Aggregator(object):
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        # Running totals for flush_stats, which only looks at the difference
+        # since its last call
+        self.total_packets = 0
+        self.total_events = 0
+        self.total_discarded_old_points = 0
+        self.parse_errors = 0
+        self.filtered = 0
+        # Server side sampling of the SHEDDABLE_TYPES, see dogstatsd.LoadShedder
+        self.load_shedding = False
+        self.shed_sample_rate = 1
+        self.shed = 0
+        # Whether submit_packets is working on a batch, and how many it is
+        # done with, for the flushes on another thread to wait on
+        self.in_batch = False
+        self.batches = 0
+        self.contexts_by_class = {}
+        self.last_stats = (time(), 0, 0, 0, 0, 0, 0, 0, 0)
+
+        self.metric_filter = metric_filter
+
+        self.context_cache = ContextCache(context_cache_size) if context_cache_size else None
+
         # Additional config passed when instantiating metric configs
         self.metric_config = {
             Histogram: {
@@ -462,6 +1039,15 @@ class Aggregator(object):
                 'percentiles': histogram_percentiles
             }
         }
+        self.metric_config[SketchHistogram] = self.metric_config[Histogram]
+        self.metric_config[ApproximateSet] = {'precision': set_precision}
+
+        # Metric classes replaced by another for the names matching a pattern
+        self.metric_class_patterns = {}
+        if sketch_histograms:
+            self.metric_class_patterns[Histogram] = (_any_glob(sketch_histograms), SketchHistogram)
+        if approximate_sets:
+            self.metric_class_patterns[Set] = (_any_glob(approximate_sets), ApproximateSet)
 
         self.utf8_decoding = utf8_decoding
 
@@ -475,6 +1061,61 @@ class Aggregator(object):
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
         """
+        split = self.split_metric_packet(packet)
+        if split is None:
+            return self.parse_multi_metric_packet(packet)
+
+        name, raw_value, metric_type, sample_rate, raw_tags = split
+        value = self.cast_metric_value(name, raw_value, metric_type)
+        tags = tuple(sorted(raw_tags.split(','))) if raw_tags is not None else None
+        return [(name, value, metric_type, tags, sample_rate)]
+
+    def split_metric_packet(self, packet):
+        """
+        Fast path for the single value form, where the only colons after the
+        name are in the tags, which come last.  Returns (name, raw_value,
+        metric_type, sample_rate, raw_tags) or None for anything else, which
+        needs the general parser.
+        """
+        name, separator, rest = packet.partition(':')
+        fields = rest.split('|')
+        colon = rest.find(':')
+        if not separator or len(fields) < 2 or (colon != -1 and (
+                len(fields) < 3 or fields[-1][:1] != '#' or colon < len(rest) - len(fields[-1]))):
+            return None
+
+        sample_rate = 1
+        raw_tags = None
+        for m in fields[2:]:
+            if m[0] == '@':
+                sample_rate = float(m[1:])
+                assert 0 <= sample_rate <= 1
+            elif m[0] == '#':
+                raw_tags = m[1:]
+
+        return name, fields[0], fields[1], sample_rate, raw_tags
+
+    def cast_metric_value(self, name, raw_value, metric_type):
+        if metric_type in self.ALLOW_STRINGS:
+            return raw_value
+        if raw_value.isdigit():
+            return int(raw_value)
+        try:
+            # int() can't parse these, don't bother raising
+            if '.' in raw_value or 'e' in raw_value or 'E' in raw_value:
+                return float(raw_value)
+            try:
+                return int(raw_value)
+            except ValueError:
+                return float(raw_value)
+        except ValueError:
+            raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
+
+    def parse_multi_metric_packet(self, packet):
+        """
+        The general parser behind parse_metric_packet, which also handles
+        several values in one packet.
+        """
         parsed_packets = []
         name_and_metadata = packet.split(':', 1)
 
@@ -621,34 +1262,124 @@ class Aggregator(object):
             raise Exception(u'Unparseable service check packet: %s' % packet)
 
     def submit_packets(self, packets):
+        self.in_batch = True
+        try:
+            self.submit_batch(packets)
+        finally:
+            self.in_batch = False
+            self.batches += 1
+
+    def wait_for_batch(self):
+        """
+        Wait for submit_packets to be done with the batch it is working on,
+        if any.  A batch only holds on to the bucket it last sampled, so past
+        that point no sample can go to a bucket the caller has taken out.  The
+        wait is bounded, in case the submitting thread is stuck.
+        """
+        batches = self.batches
+        # Not time, which the tests stop
+        started = default_timer()
+        while self.in_batch and self.batches == batches:
+            waited = default_timer() - started
+            if waited >= BATCH_WAIT_TIMEOUT:
+                log.warning('A batch has been submitted for more than %.1fs' % waited)
+                return False
+            sleep(BATCH_WAIT_STEP)
+        return True
+
+    def submit_batch(self, packets):
         # We should probably consider that packets are always encoded
         # in utf8, but decoding all packets has an perf overhead of 7%
         # So we let the user decide if we wants utf8 by default
         # Keep a very conservative approach anyhow
         # Clients MUST always send UTF-8 encoded content
-        if self.utf8_decoding:
-            packets = unicode(packets, 'utf-8', errors='replace')
+        # Lines are parsed as bytes though, and only the names and tags of new
+        # contexts, set members and lines off the fast path get decoded.
+        decode = self.utf8_decoding and isinstance(packets, str)
+
+        context_cache = self.context_cache
+        cast_metric_value = self.cast_metric_value
+        # Straight to the sampling unless shedding
+        submit_context = self.submit_context if self.shed_sample_rate < 1 else self.sample_context
+        allow_strings = self.ALLOW_STRINGS
+
+        # Single value metric lines are found by running METRIC_LINE over the
+        # whole batch, the lines in between go through the general parsers.
+        pos = 0
+        for match in METRIC_LINE.finditer(packets):
+            start = match.start()
+            if start > pos:
+                self._submit_lines(packets[pos:start], decode)
+            # Past the newline ending the match
+            pos = match.end() + 1
+
+            # The server hands us whole batches of datagrams, so a malformed
+            # line must not cost us the lines that follow it.
+            try:
+                name, raw_value, mtype, raw_rate, raw_tags = match.groups()
+                key = (name, mtype, raw_tags)
+                entry = context_cache.get(key) if context_cache is not None else None
+                if entry is None:
+                    if decode:
+                        name = decode_utf8(name)
+                        raw_tags = decode_utf8(raw_tags) if raw_tags is not None else None
+                    entry = self.make_context(name, tuple(sorted(raw_tags.split(',')))
+                                              if raw_tags is not None else None)
+                    if context_cache is not None:
+                        context_cache.put(key, entry)
+                if entry is FILTERED:
+                    # Dropped before even looking at the value
+                    self.filtered += 1
+                    self.count += 1
+                    continue
+
+                if raw_value.isdigit() and mtype not in allow_strings:
+                    value = int(raw_value)
+                else:
+                    value = cast_metric_value(name, raw_value, mtype)
+                    if decode and mtype in allow_strings:
+                        value = decode_utf8(value)
+                sample_rate = 1
+                if raw_rate is not None:
+                    sample_rate = float(raw_rate)
+                    assert 0 <= sample_rate <= 1
+
+                submit_context(entry[0], entry[1], value, mtype, sample_rate=sample_rate)
+                self.count += 1
+            except Exception:
+                self.parse_errors += 1
+                log.exception('Error parsing packet: %r' % match.group(0))
 
+        if pos < len(packets):
+            self._submit_lines(packets[pos:], decode)
+
+    def _submit_lines(self, packets, decode):
+        """ Line by line parsing, for whatever METRIC_LINE doesn't match """
         for packet in packets.splitlines():
             if not packet.strip():
                 continue
 
-            if packet.startswith('_e'):
-                self.event_count += 1
-                event = self.parse_event_packet(packet)
-                self.event(**event)
-            elif packet.startswith('_sc'):
-                self.service_check_count += 1
-                service_check = self.parse_sc_packet(packet)
-                self.service_check(**service_check)
-            else:
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                                       device_name=device_name, sample_rate=sample_rate)
-                self.count += 1
-
+            try:
+                if decode:
+                    packet = unicode(packet, 'utf-8', errors='replace')
+                if packet.startswith('_e'):
+                    self.event_count += 1
+                    event = self.parse_event_packet(packet)
+                    self.event(**event)
+                elif packet.startswith('_sc'):
+                    self.service_check_count += 1
+                    service_check = self.parse_sc_packet(packet)
+                    self.service_check(**service_check)
+                else:
+                    parsed_packets = self.parse_metric_packet(packet)
+                    for name, value, mtype, tags, sample_rate in parsed_packets:
+                        hostname, device_name, tags = self._extract_magic_tags(tags)
+                        self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                                           device_name=device_name, sample_rate=sample_rate)
+                    self.count += 1
+            except Exception:
+                self.parse_errors += 1
+                log.exception('Error parsing packet: %r' % packet)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -672,9 +1403,67 @@ class Aggregator(object):
                 tags = tuple(tags) or None
         return hostname, device_name, tags
 
+    def make_context(self, name, tags):
+        """
+        Returns the context of a metric line's name and sorted tags, and the
+        tags left once the magic ones are taken out, or FILTERED.
+        """
+        hostname, device_name, tags = self._extract_magic_tags(tags)
+        if self.metric_filter is not None:
+            filtered = self.metric_filter.apply(name, tags)
+            if filtered is None:
+                return FILTERED
+            name, tags = filtered
+        return self.context(name, tags, hostname, device_name), tags
+
+    def context(self, name, tags, hostname, device_name):
+        # Avoid calling extra functions to dedupe tags if there are none
+        # Note: if you change the way that context is created, please also change create_empty_metrics,
+        #  which counts on this order
+
+        # Keep hostname with empty string to unset it
+        hostname = hostname if hostname is not None else self.hostname
+
+        if tags is None:
+            return (name, tuple(), hostname, device_name)
+        return (name, tuple(sorted(set(tags))), hostname, device_name)
+
+    def metric_class(self, name, mtype):
+        """ The class of the metrics of a new context """
+        metric_class = self.metric_type_to_class[mtype]
+        pattern = self.metric_class_patterns.get(metric_class)
+        if pattern is not None and pattern[0](name):
+            return pattern[1]
+        return metric_class
+
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
         """ Add a metric to be aggregated """
+        if self.metric_filter is not None:
+            filtered = self.metric_filter.apply(name, tags)
+            if filtered is None:
+                self.filtered += 1
+                return
+            name, tags = filtered
+        self.submit_context(self.context(name, tags, hostname, device_name), tags,
+                            value, mtype, timestamp, sample_rate)
+
+    def submit_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
+        """
+        Add a metric whose context is already known, unless load shedding
+        drops it.  The samples of the SHEDDABLE_TYPES that are kept count for
+        the shed ones, as for client side sampling.
+        """
+        shed_sample_rate = self.shed_sample_rate
+        if shed_sample_rate < 1 and mtype in self.SHEDDABLE_TYPES:
+            if random.random() >= shed_sample_rate:
+                self.shed += 1
+                return
+            sample_rate *= shed_sample_rate
+        self.sample_context(context, tags, value, mtype, timestamp, sample_rate)
+
+    def sample_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
+        """ Sample the metric of a context, whatever the load """
         raise NotImplementedError()
 
     def event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
@@ -731,6 +1520,7 @@ class Aggregator(object):
         self.events = []
 
         self.total_count += self.event_count
+        self.total_events += self.event_count
         self.event_count = 0
 
         log.debug("Received %d events since last flush" % len(events))
@@ -751,6 +1541,47 @@ class Aggregator(object):
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def flush_stats(self):
+        """
+        Internal metrics about the aggregator since the previous call, as a
+        list of (name, value, metric_type, tags).
+        """
+        cur_time = time()
+        current = (cur_time,
+                   self.total_packets + self.count,
+                   self.total_events + self.event_count,
+                   self.parse_errors,
+                   self.total_discarded_old_points + self.num_discarded_old_points,
+                   self.context_cache.hits if self.context_cache else 0,
+                   self.context_cache.misses if self.context_cache else 0,
+                   self.filtered,
+                   self.shed)
+        last = self.last_stats
+        self.last_stats = current
+
+        elapsed = cur_time - last[0]
+        stats = [
+            ('packets_per_second', (current[1] - last[1]) / elapsed if elapsed > 0 else 0, MetricTypes.GAUGE, None),
+            ('events', current[2] - last[2], MetricTypes.COUNT, None),
+            ('parse_errors', current[3] - last[3], MetricTypes.COUNT, None),
+            ('discarded_old_points', current[4] - last[4], MetricTypes.COUNT, None),
+        ]
+        if self.metric_filter is not None:
+            stats.append(('filtered', current[7] - last[7], MetricTypes.COUNT, None))
+        if self.load_shedding:
+            stats += [
+                ('shed', current[8] - last[8], MetricTypes.COUNT, None),
+                ('shed_sample_rate', self.shed_sample_rate, MetricTypes.GAUGE, None),
+            ]
+        if self.context_cache is not None:
+            stats += [
+                ('context_cache.hits', current[5] - last[5], MetricTypes.COUNT, None),
+                ('context_cache.misses', current[6] - last[6], MetricTypes.COUNT, None),
+            ]
+        for metric_class, contexts in sorted(self.contexts_by_class.items()):
+            stats.append(('contexts', contexts, MetricTypes.GAUGE, ('metric_class:%s' % metric_class,)))
+        return stats
+
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
@@ -759,7 +1590,9 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=CONTEXT_CACHE_SIZE,
+                 max_contexts_per_metric=0, max_contexts=0, metric_filter=None,
+                 sketch_histograms=None, approximate_sets=None, set_precision=HLL_PRECISION):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -768,43 +1601,47 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            metric_filter,
+            sketch_histograms,
+            approximate_sets,
+            set_precision
         )
         self.metric_by_bucket = {}
+        # Completed buckets of shards, see merge_from, only ever touched by
+        # the flushing thread
+        self.merged_buckets = {}
+        # Buckets retired while a batch was still writing to them, flushed
+        # once it is done, also only touched by the flushing thread
+        self.stalled_buckets = []
         self.last_sample_time_by_context = {}
+        self.counter_expiry_index = []
+        # The bucket last sampled, reset for every batch, see retire_buckets
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = 0
+        self.cardinality_limiter = None
+        if max_contexts_per_metric or max_contexts:
+            self.cardinality_limiter = CardinalityLimiter(max_contexts_per_metric, max_contexts)
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
             'h': Histogram,
             'ms': Histogram,
+            'd': Distribution,
             's': Set,
         }
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                      device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also change create_empty_metrics,
-        #  which counts on this order
-
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
-
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
-
+    def sample_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             timestamp = timestamp or cur_time
@@ -813,31 +1650,124 @@ class MetricsBucketAggregator(Aggregator):
             if bucket_start_timestamp == self.current_bucket:
                 metric_by_context = self.current_mbc
             else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+                metric_by_context = self.metric_by_bucket.get(bucket_start_timestamp)
+                if metric_by_context is None:
+                    metric_by_context = self.metric_by_bucket.setdefault(bucket_start_timestamp, {})
                 self.current_bucket = bucket_start_timestamp
                 self.current_mbc = metric_by_context
 
             if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                                                          hostname, device_name, self.metric_config.get(metric_class))
+                if self.cardinality_limiter is not None:
+                    context, tags = self.cardinality_limiter.admit(context, tags, mtype)
+                if context not in metric_by_context:
+                    metric_class = self.metric_class(context[0], mtype)
+                    metric_by_context[context] = metric_class(self.formatter, context,
+                                                              self.metric_config.get(metric_class))
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
-        # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
-        #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
+    def merge_from(self, other):
+        """
+        Move the completed buckets of another aggregator (a shard fed by its
+        own listener) into this one, merging metrics that share a context, so
+        that the next flush reports them as if they had all been received here.
+        They are retired from the shard like for a flush of its own, and kept
+        apart from the buckets this one's listener writes to until then.
+        """
+        flush_cutoff_time = self.calculate_bucket_start(time())
+        self.merge_buckets(self.merged_buckets, other.retire_buckets(flush_cutoff_time))
+        # The shard never flushes itself
+        other.reset_cardinality_limiter()
+
+    def submit_batch(self, packets):
+        self.current_bucket = None
+        super(MetricsBucketAggregator, self).submit_batch(packets)
+
+    def merge_buckets(self, into, metric_by_bucket):
+        """ Fold the buckets of metric_by_bucket into those of into """
+        for bucket_start_timestamp, other_mbc in metric_by_bucket.iteritems():
+            metric_by_context = into.get(bucket_start_timestamp)
+            if metric_by_context is None:
+                into[bucket_start_timestamp] = other_mbc
+                continue
+            for context, metric in other_mbc.iteritems():
+                if context in metric_by_context:
+                    metric_by_context[context].merge(metric)
+                else:
+                    metric_by_context[context] = metric
+
+    def retire_buckets(self, flush_cutoff_time):
+        """
+        Take the buckets before flush_cutoff_time out of metric_by_bucket, for
+        the flush to work on while the listener goes on filling the current
+        one.  Each is popped in one go, and once the batch in flight is done
+        they are the flush's alone: the listener never waits on the flush,
+        only the flush on the rest of a batch.  Only that batch may have kept
+        one as its current bucket, the next one starts afresh.  If the batch
+        isn't done in time nothing is retired, the popped buckets wait in
+        stalled_buckets for the next flush.
+        """
+        retired = self.pop_buckets(self.metric_by_bucket, flush_cutoff_time)
+        if retired or self.stalled_buckets:
+            if not self.wait_for_batch():
+                self.stalled_buckets.append(retired)
+                return {}
+            # For submit_context outside of submit_packets
+            self.current_bucket = None
+        for stalled in self.stalled_buckets:
+            self.merge_buckets(retired, stalled)
+        self.stalled_buckets = []
+        self.merge_buckets(retired, self.merged_buckets)
+        self.merged_buckets = {}
+        return retired
+
+    def pop_buckets(self, buckets, flush_cutoff_time):
+        """ Pop the buckets before flush_cutoff_time out of buckets """
+        popped = {}
+        for bucket_start_timestamp in buckets.keys():
+            if bucket_start_timestamp < flush_cutoff_time:
+                popped[bucket_start_timestamp] = buckets.pop(bucket_start_timestamp)
+        return popped
+
+    def expire_counters(self, expiry_timestamp):
+        """
+        Forget the counters last sampled before expiry_timestamp.  The index
+        is a heap of (last sample time, context) with one entry per known
+        counter, whose time may be older than the real one: such entries are
+        pushed back with the right time rather than expired.
+        """
+        index = self.counter_expiry_index
+        last_sample_time_by_context = self.last_sample_time_by_context
+        while index and index[0][0] < expiry_timestamp:
+            _, context = heapq.heappop(index)
+            last_sample_time = last_sample_time_by_context.get(context)
+            if last_sample_time is None:
+                continue
             if last_sample_time < expiry_timestamp:
                 log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
+                del last_sample_time_by_context[context]
             else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+                heapq.heappush(index, (last_sample_time, context))
+
+    def create_empty_metrics(self, metric_by_context, flush_timestamp, metrics):
+        # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
+        #  (Set, Gauge, Histogram) do not report if no data is submitted
+        formatter = self.formatter
+        interval = self.interval
+        value = 0 / interval
+        for context in self.last_sample_time_by_context:
+            if not isinstance(metric_by_context.get(context), Counter):
+                # What flushing a Counter without samples gives
+                metrics.append(formatter(
+                    metric=context[0],
+                    value=value,
+                    timestamp=flush_timestamp,
+                    tags=context[1] or None,
+                    hostname=context[2],
+                    device_name=context[3],
+                    metric_type=MetricTypes.RATE,
+                    interval=interval,
+                ))
 
     def flush(self):
         cur_time = time()
@@ -845,50 +1775,489 @@ class MetricsBucketAggregator(Aggregator):
         expiry_timestamp = cur_time - self.expiry_seconds
 
         metrics = []
+        contexts_by_class = {}
+        retired = self.retire_buckets(flush_cutoff_time)
+        self.flush_buckets(retired, flush_cutoff_time, expiry_timestamp, metrics, contexts_by_class)
+        self.finish_flush(flush_cutoff_time, contexts_by_class)
+        return metrics
+
+    def flush_buckets(self, retired, flush_cutoff_time, expiry_timestamp, metrics, contexts_by_class):
+        """
+        Flush the metrics of the retired buckets into metrics, and add their
+        contexts to the sets of contexts_by_class, so that a context sampled
+        in several of them counts once.
+        """
+        last_sample_time_by_context = self.last_sample_time_by_context
+        self.expire_counters(expiry_timestamp)
 
-        if self.metric_by_bucket:
+        if retired:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
-                        if metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
-        else:
+            #  re-create non-expired metrics.
+            for bucket_start_timestamp in sorted(retired.keys()):
+                metric_by_context = retired[bucket_start_timestamp]
+                for context, metric in metric_by_context.iteritems():
+                    metric_class = metric.__class__.__name__
+                    contexts = contexts_by_class.get(metric_class)
+                    if contexts is None:
+                        contexts = contexts_by_class[metric_class] = set()
+                    contexts.add(context)
+                    if metric.last_sample_time < expiry_timestamp:
+                        # This should never happen
+                        log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                        last_sample_time_by_context.pop(context, None)
+                    else:
+                        metrics += metric.flush(bucket_start_timestamp, self.interval)
+                        if isinstance(metric, Counter):
+                            if context not in last_sample_time_by_context:
+                                heapq.heappush(self.counter_expiry_index, (metric.last_sample_time, context))
+                            last_sample_time_by_context[context] = metric.last_sample_time
+                # We need to account for Metrics that have not expired and were not flushed for this bucket
+                self.create_empty_metrics(metric_by_context, bucket_start_timestamp, metrics)
+        elif not self.metric_by_bucket and not self.stalled_buckets:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+                self.create_empty_metrics({}, flush_cutoff_time-self.interval, metrics)
 
+    def finish_flush(self, flush_cutoff_time, contexts_by_class):
+        """ Roll the stats over and reset the per flush state """
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
+            self.total_discarded_old_points += self.num_discarded_old_points
             self.num_discarded_old_points = 0
 
         # Save some stats.
         # log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
+        self.total_packets += self.count
         self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
+        # Kept on flushes too early to retire a bucket, and once one is due
+        # the classes without contexts report zeros rather than going stale
+        if contexts_by_class or flush_cutoff_time > self.last_flush_cutoff_time:
+            counts = dict.fromkeys(self.contexts_by_class, 0)
+            for metric_class, contexts in contexts_by_class.iteritems():
+                counts[metric_class] = len(contexts)
+            self.contexts_by_class = counts
         self.last_flush_cutoff_time = flush_cutoff_time
-        return metrics
+        self.reset_cardinality_limiter()
+
+    def reset_cardinality_limiter(self):
+        """
+        Start a new interval of the cardinality limiter, from the contexts
+        still held.  Done at the end of a flush, or by merge_from for a shard.
+        """
+        if self.cardinality_limiter is not None:
+            limited = self.cardinality_limiter.limited
+            if limited:
+                log.warning('Too many contexts, samples of %s went to %s contexts' %
+                            (', '.join(sorted(limited)), CardinalityLimiter.OVERFLOW))
+            self.cardinality_limiter.reset(self.held_contexts())
+
+    def held_contexts(self):
+        """ The contexts of the buckets still to be flushed """
+        # Copies, the listener may be adding to them
+        for metric_by_context in self.metric_by_bucket.values():
+            for context in list(metric_by_context):
+                yield context
+
+    def flush_stats(self):
+        stats = super(MetricsBucketAggregator, self).flush_stats()
+        if self.cardinality_limiter is not None:
+            for name, samples in sorted(self.cardinality_limiter.pop_limited().items()):
+                stats.append(('cardinality.limited', samples, MetricTypes.COUNT, ('metric:%s' % name,)))
+        return stats
+
+
+class BucketColumns(object):
+    """
+    The gauge and counter samples of a bucket of a ColumnarAggregator, in
+    columns indexed by context id: value, last sample time, whether the
+    context was sampled in this bucket and whether its gauge value is an int.
+
+    Values are doubles, so an int gauge is reported as an int again but, like
+    a counter, is only exact up to 2**53.
+    """
+
+    __slots__ = ('values', 'sample_times', 'sampled', 'ints')
+
+    def __init__(self):
+        self.values = array('d')
+        self.sample_times = array('d')
+        self.sampled = bytearray()
+        self.ints = bytearray()
+
+    def grow(self, size):
+        missing = size - len(self.sampled)
+        if missing > 0:
+            zeros = array('d', [0.0]) * missing
+            self.values.extend(zeros)
+            self.sample_times.extend(zeros)
+            self.sampled.extend(bytearray(missing))
+            self.ints.extend(bytearray(missing))
+
+
+class ColumnarAggregator(MetricsBucketAggregator):
+    """
+    A MetricsBucketAggregator that keeps its gauges and counters in columns
+    rather than in a Metric per context, for the hosts with the most of them.
+
+    Each context gets an integer id the first time it is seen, which indexes
+    the columns of the context table (context_names, context_tags, and so
+    on, kinds and last_sample_times) and the BucketColumns of every bucket.  The
+    flush selects the ids to report from whole columns, with NumPy when it
+    is available, and hands the formatter the output a column at a time.
+    Ids of contexts not sampled for expiry_seconds are recycled by the
+    listener, see recycle_ids.
+
+    Histograms, timers, sets and distributions are left to the
+    MetricsBucketAggregator.
+    """
+
+    # Kinds of context ids, a counter is known once it has been flushed and
+    # from then on reports zeros until it expires
+    FREE, GAUGE, COUNTER, KNOWN_COUNTER = 0, 1, 2, 3
+    COLUMN_KINDS = {'g': GAUGE, 'c': COUNTER}
+
+    def __init__(self, *args, **kwargs):
+        super(ColumnarAggregator, self).__init__(*args, **kwargs)
+        self.context_ids = {}
+        self.free_ids = []
+        self.contexts = []
+        self.context_names = []
+        self.context_tags = []
+        self.context_hostnames = []
+        self.context_device_names = []
+        self.kinds = bytearray()
+        self.last_sample_times = array('d')
+        self.columns_by_bucket = {}
+        self.current_column_bucket = None
+        self.current_columns = None
+        self.merged_columns = {}
+        # The ids the last flush found expired, with the generation they are
+        # good for, which is bumped whenever columns may have been retired
+        # without recycle_ids having seen them
+        self.generation = 0
+        self.expired_ids = (0, [])
+        # Ids are made by the listener and by merge_from
+        self.id_lock = threading.Lock()
+
+    def new_context_id(self, context, kind, cur_time):
+        with self.id_lock:
+            context_id = self.context_ids.get(context)
+            if context_id is None:
+                context_id = self._new_context_id(context, kind, cur_time)
+            return context_id
+
+    def _new_context_id(self, context, kind, cur_time):
+        if self.free_ids:
+            context_id = self.free_ids.pop()
+            self.contexts[context_id] = context
+            self.context_names[context_id] = context[0]
+            self.context_tags[context_id] = context[1] or None
+            self.context_hostnames[context_id] = context[2]
+            self.context_device_names[context_id] = context[3]
+            self.kinds[context_id] = kind
+            self.last_sample_times[context_id] = cur_time
+        else:
+            context_id = len(self.kinds)
+            self.contexts.append(context)
+            self.context_names.append(context[0])
+            self.context_tags.append(context[1] or None)
+            self.context_hostnames.append(context[2])
+            self.context_device_names.append(context[3])
+            self.kinds.append(kind)
+            self.last_sample_times.append(cur_time)
+        # Last, so that a flush never sees a half made id
+        self.context_ids[context] = context_id
+        return context_id
+
+    def sample_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
+        kind = self.COLUMN_KINDS.get(mtype)
+        if kind is None:
+            return super(ColumnarAggregator, self).sample_context(context, tags, value, mtype,
+                                                                  timestamp, sample_rate)
+        cur_time = time()
+        if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
+            self.num_discarded_old_points += 1
+            return
+
+        bucket_start_timestamp = self.calculate_bucket_start(timestamp or cur_time)
+        if bucket_start_timestamp == self.current_column_bucket:
+            columns = self.current_columns
+        else:
+            columns = self.columns_by_bucket.get(bucket_start_timestamp)
+            if columns is None:
+                columns = self.columns_by_bucket.setdefault(bucket_start_timestamp, BucketColumns())
+            self.current_column_bucket = bucket_start_timestamp
+            self.current_columns = columns
+
+        context_id = self.context_ids.get(context)
+        if context_id is None or context_id >= len(columns.sampled) or not columns.sampled[context_id]:
+            # New to this bucket
+            if self.cardinality_limiter is not None:
+                context, tags = self.cardinality_limiter.admit(context, tags, mtype)
+                context_id = self.context_ids.get(context)
+            if context_id is None:
+                context_id = self.new_context_id(context, kind, cur_time)
+            if context_id >= len(columns.sampled):
+                columns.grow(len(self.kinds))
+            columns.sampled[context_id] = 1
+
+        if self.kinds[context_id] == self.GAUGE:
+            columns.values[context_id] = value
+            columns.ints[context_id] = isinstance(value, (int, long))
+        else:
+            columns.values[context_id] += value * int(1 / sample_rate)
+        columns.sample_times[context_id] = cur_time
+
+    def submit_batch(self, packets):
+        self.current_column_bucket = None
+        self.recycle_ids()
+        super(ColumnarAggregator, self).submit_batch(packets)
+
+    def recycle_ids(self):
+        """
+        Free the ids the last flush found expired, unless sampled since.  The
+        listener does it at the start of a batch, as nothing can look an id
+        up and sample it in between.  The buckets are checked before the
+        generation, which every flush bumps before taking buckets out, so the
+        ones retired since the expired ids were found are never missed.
+        """
+        generation, expired = self.expired_ids
+        if not expired or not self.id_lock.acquire(False):
+            return
+        try:
+            sampled_columns = [columns.sampled for columns in self.columns_by_bucket.values()]
+            if generation != self.generation:
+                return
+            self.expired_ids = (generation, [])
+            for context_id in expired:
+                if self.kinds[context_id] == self.FREE or \
+                        any(context_id < len(sampled) and sampled[context_id]
+                            for sampled in sampled_columns):
+                    # Sampled again
+                    continue
+                context = self.contexts[context_id]
+                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                del self.context_ids[context]
+                self.kinds[context_id] = self.FREE
+                self.contexts[context_id] = None
+                self.context_names[context_id] = None
+                self.context_tags[context_id] = None
+                self.context_hostnames[context_id] = None
+                self.context_device_names[context_id] = None
+                self.free_ids.append(context_id)
+        finally:
+            self.id_lock.release()
+
+    def retire_buckets(self, flush_cutoff_time):
+        """ The retired buckets, with the retired columns """
+        self.generation += 1
+        metric_by_bucket = self.pop_buckets(self.metric_by_bucket, flush_cutoff_time)
+        columns_by_bucket = self.pop_buckets(self.columns_by_bucket, flush_cutoff_time)
+        if metric_by_bucket or columns_by_bucket or self.stalled_buckets:
+            if not self.wait_for_batch():
+                self.stalled_buckets.append((metric_by_bucket, columns_by_bucket))
+                return {}, {}
+            self.current_bucket = None
+            self.current_column_bucket = None
+        for stalled, stalled_columns in self.stalled_buckets:
+            self.merge_buckets(metric_by_bucket, stalled)
+            self.fold_columns(columns_by_bucket, stalled_columns)
+        self.stalled_buckets = []
+        self.merge_buckets(metric_by_bucket, self.merged_buckets)
+        self.merged_buckets = {}
+        self.fold_columns(columns_by_bucket, self.merged_columns)
+        self.merged_columns = {}
+        return metric_by_bucket, columns_by_bucket
+
+    def fold_columns(self, into, columns_by_bucket):
+        """ Fold the columns of columns_by_bucket into those of into """
+        for bucket_start_timestamp, columns in columns_by_bucket.iteritems():
+            if bucket_start_timestamp in into:
+                self.merge_columns(into[bucket_start_timestamp], columns)
+            else:
+                into[bucket_start_timestamp] = columns
+
+    def merge_from(self, other):
+        cur_time = time()
+        flush_cutoff_time = self.calculate_bucket_start(cur_time)
+        metric_by_bucket, columns_by_bucket = other.retire_buckets(flush_cutoff_time)
+        self.merge_buckets(self.merged_buckets, metric_by_bucket)
+        # Lets a recycle_ids that is under way finish, any later one sees
+        # the expired ids are stale
+        self.generation += 1
+        with self.id_lock:
+            pass
+        for bucket_start_timestamp, other_columns in columns_by_bucket.iteritems():
+            columns = self.merged_columns.setdefault(bucket_start_timestamp, BucketColumns())
+            self.merge_columns(columns, other_columns, other)
+        other.reset_cardinality_limiter()
+        # For the shard's listener to recycle, as a flush of its own would
+        if not other.stalled_buckets:
+            other.expired_ids = (other.generation,
+                                 other.find_expired_ids(len(other.kinds), cur_time - other.expiry_seconds))
+
+    def merge_columns(self, columns, other_columns, other=None):
+        """
+        Fold the samples of other_columns into columns, their ids are those
+        of the other aggregator if given, of this one otherwise.
+        """
+        for other_id, sampled in enumerate(other_columns.sampled):
+            if not sampled:
+                continue
+            sample_time = other_columns.sample_times[other_id]
+            if other is None:
+                context_id = other_id
+            else:
+                context = other.contexts[other_id]
+                context_id = self.context_ids.get(context)
+                if context_id is None:
+                    context_id = self.new_context_id(context, min(other.kinds[other_id], self.COUNTER), sample_time)
+                # Only merged, the shard's ids expire by the samples it hands over
+                if sample_time > other.last_sample_times[other_id]:
+                    other.last_sample_times[other_id] = sample_time
+            if context_id >= len(columns.sampled):
+                columns.grow(len(self.kinds))
+            if self.kinds[context_id] != self.GAUGE:
+                columns.values[context_id] += other_columns.values[other_id]
+            elif not columns.sampled[context_id] or sample_time >= columns.sample_times[context_id]:
+                # Last write wins
+                columns.values[context_id] = other_columns.values[other_id]
+                columns.ints[context_id] = other_columns.ints[other_id]
+            columns.sampled[context_id] = 1
+            columns.sample_times[context_id] = max(sample_time, columns.sample_times[context_id])
+
+    def select_ids(self, columns, size, expiry_timestamp):
+        """
+        The ids of a bucket's gauges and counters, and of the known counters
+        it has no samples for, which report zeros.
+        """
+        if not size:
+            return [], [], []
+        # The times before the kinds: an id the listener recycles in between
+        # is then never taken for a known counter
+        last_sample_times = self.last_sample_times[:size]
+        kinds = self.kinds[:size]
+        sampled = columns.sampled[:size]
+        if len(sampled) < size:
+            sampled.extend(bytearray(size - len(sampled)))
+        if numpy is not None:
+            kinds = numpy.frombuffer(bytes(kinds), dtype=numpy.uint8)
+            sampled = numpy.frombuffer(bytes(sampled), dtype=numpy.uint8).astype(bool)
+            last_sample_times = numpy.frombuffer(last_sample_times, dtype=numpy.float64)
+            gauges = sampled & (kinds == self.GAUGE)
+            counters = sampled & (kinds >= self.COUNTER)
+            zeros = ~sampled & (kinds == self.KNOWN_COUNTER) & (last_sample_times >= expiry_timestamp)
+            return (numpy.flatnonzero(gauges).tolist(), numpy.flatnonzero(counters).tolist(),
+                    numpy.flatnonzero(zeros).tolist())
+        gauges = []
+        counters = []
+        zeros = []
+        for context_id, kind in enumerate(kinds):
+            if sampled[context_id]:
+                if kind == self.GAUGE:
+                    gauges.append(context_id)
+                elif kind:
+                    counters.append(context_id)
+            elif kind == self.KNOWN_COUNTER and last_sample_times[context_id] >= expiry_timestamp:
+                zeros.append(context_id)
+        return gauges, counters, zeros
+
+    def emit(self, context_ids, values, timestamp, metric_type, metrics):
+        """ Format the points of context_ids, a column at a time """
+        count = len(context_ids)
+        metrics.extend(map(self.formatter,
+                           map(self.context_names.__getitem__, context_ids),
+                           values,
+                           [timestamp] * count,
+                           map(self.context_tags.__getitem__, context_ids),
+                           map(self.context_hostnames.__getitem__, context_ids),
+                           map(self.context_device_names.__getitem__, context_ids),
+                           [metric_type] * count,
+                           [self.interval] * count))
+
+    def flush_buckets(self, retired, flush_cutoff_time, expiry_timestamp, metrics, contexts_by_class):
+        metric_by_bucket, columns_by_bucket = retired
+        super(ColumnarAggregator, self).flush_buckets(metric_by_bucket, flush_cutoff_time,
+                                                      expiry_timestamp, metrics, contexts_by_class)
+        interval = self.interval
+        size = len(self.kinds)
+        for bucket_start_timestamp in sorted(columns_by_bucket.keys()):
+            columns = columns_by_bucket[bucket_start_timestamp]
+            gauges, counters, zeros = self.select_ids(columns, size, expiry_timestamp)
+            values = columns.values
+            if numpy is not None:
+                values = numpy.frombuffer(values, dtype=numpy.float64)
+                rates = (values[counters] / interval).tolist()
+                gauge_values = values[gauges].tolist()
+            else:
+                rates = [values[context_id] / interval for context_id in counters]
+                gauge_values = map(values.__getitem__, gauges)
+            ints = columns.ints
+            for i, context_id in enumerate(gauges):
+                if ints[context_id]:
+                    gauge_values[i] = int(gauge_values[i])
+            self.emit(counters, rates, bucket_start_timestamp, MetricTypes.RATE, metrics)
+            self.emit(gauges, gauge_values, bucket_start_timestamp, MetricTypes.GAUGE, metrics)
+            self.emit(zeros, [0.0] * len(zeros), bucket_start_timestamp, MetricTypes.RATE, metrics)
+            # Only the sampled ids change
+            for context_id in gauges:
+                self.last_sample_times[context_id] = columns.sample_times[context_id]
+            for context_id in counters:
+                self.last_sample_times[context_id] = columns.sample_times[context_id]
+                self.kinds[context_id] = self.KNOWN_COUNTER
+            # By id, which can't be mistaken for the contexts of the metrics
+            if gauges:
+                contexts_by_class.setdefault('BucketGauge', set()).update(gauges)
+            if counters:
+                contexts_by_class.setdefault('Counter', set()).update(counters)
+
+        if not columns_by_bucket and not self.columns_by_bucket and not self.stalled_buckets and \
+                flush_cutoff_time >= self.last_flush_cutoff_time + interval:
+            # Even without samples, known counters report zeros
+            _, _, zeros = self.select_ids(BucketColumns(), size, expiry_timestamp)
+            self.emit(zeros, [0.0] * len(zeros), flush_cutoff_time - interval, MetricTypes.RATE, metrics)
+
+        if not self.stalled_buckets:
+            # Or ids only sampled in those could be recycled
+            self.expired_ids = (self.generation, self.find_expired_ids(size, expiry_timestamp))
+
+    def find_expired_ids(self, size, expiry_timestamp):
+        """ The ids not sampled since expiry_timestamp, for recycle_ids """
+        if not size:
+            return []
+        if numpy is not None:
+            kinds = numpy.frombuffer(bytes(self.kinds[:size]), dtype=numpy.uint8)
+            last_sample_times = numpy.frombuffer(self.last_sample_times[:size], dtype=numpy.float64)
+            expired = numpy.flatnonzero((kinds != self.FREE) & (last_sample_times < expiry_timestamp)).tolist()
+        else:
+            last_sample_times = self.last_sample_times
+            expired = [context_id for context_id, kind in enumerate(self.kinds[:size])
+                       if kind != self.FREE and last_sample_times[context_id] < expiry_timestamp]
+        return expired
+
+    def flush(self):
+        # The output is as many dicts as contexts, none of them in a cycle,
+        # so don't let them set off garbage collections of the whole heap
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return super(ColumnarAggregator, self).flush()
+        finally:
+            if enabled:
+                gc.enable()
+
+    def held_contexts(self):
+        for context in super(ColumnarAggregator, self).held_contexts():
+            yield context
+        contexts = self.contexts
+        for columns in self.columns_by_bucket.values():
+            for context_id, sampled in enumerate(bytes(columns.sampled)):
+                if sampled != '\0' and contexts[context_id] is not None:
+                    yield contexts[context_id]
 
 
 class MetricsAggregator(Aggregator):
@@ -899,7 +2268,9 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=CONTEXT_CACHE_SIZE,
+                 metric_filter=None, sketch_histograms=None, approximate_sets=None,
+                 set_precision=HLL_PRECISION):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -908,7 +2279,12 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_size,
+            metric_filter,
+            sketch_histograms,
+            approximate_sets,
+            set_precision
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -918,28 +2294,18 @@ class MetricsAggregator(Aggregator):
             'c': Counter,
             'h': Histogram,
             'ms': Histogram,
+            'd': Distribution,
             's': Set,
             '_dd-r': Rate,
         }
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                      device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
-
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+    def sample_context(self, context, tags, value, mtype, timestamp=None, sample_rate=1):
         if context not in self.metrics:
-            metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                                                 hostname, device_name, self.metric_config.get(metric_class))
+            metric_class = self.metric_class(context[0], mtype)
+            self.metrics[context] = metric_class(self.formatter, context, self.metric_config.get(metric_class))
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             self.metrics[context].sample(value, sample_rate, timestamp)
@@ -987,11 +2353,13 @@ class MetricsAggregator(Aggregator):
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
+            self.total_discarded_old_points += self.num_discarded_old_points
             self.num_discarded_old_points = 0
 
         # Save some stats.
         # log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
+        self.total_packets += self.count
         self.count = 0
         return metrics
 
@@ -0,0 +1,273 @@
+"""
+Micro-benchmarks for the dogstatsd receive and aggregation paths.
+
+    python bench_dogstatsd.py [once] [benchmark ...]
+
+With ``once`` every benchmark runs with a tiny workload, which is only useful
+as a smoke test.
+"""
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import aggregator as aggregator_module
+import dogstatsd
+from aggregator import METRIC_LINE, ColumnarAggregator, Histogram, MetricsBucketAggregator, api_formatter
+
+ONCE = False
+
+log = logging.getLogger('dogstatsd')
+
+
+def report(name, value, unit):
+    print '%-50s %14.1f %s' % (name, value, unit)
+
+
+def _blast(port, packets, duration):
+    """ Send ``packets`` round robin to localhost:port for ``duration``s """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for packet in packets:
+            try:
+                sock.sendto(packet, ('127.0.0.1', port))
+            except socket.error:
+                pass
+
+
+def _receive_rate(port, duration, **server_args):
+    aggregator = MetricsBucketAggregator(None, 10, utf8_decoding=True)
+    server = dogstatsd.Server(aggregator, '127.0.0.1', port, timeout=.1,
+                              **server_args)
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    time.sleep(.2)
+
+    packets = ['page.views:1|c|#country:china,service:web%d' % i
+               for i in range(100)]
+    sender = multiprocessing.Process(target=_blast,
+                                     args=(port, packets, duration))
+    start = time.time()
+    sender.start()
+    sender.join()
+    # Give the server a moment to drain its receive buffer
+    last = -1
+    while aggregator.count != last:
+        last = aggregator.count
+        time.sleep(.2)
+    elapsed = time.time() - start - .2
+
+    server.stop()
+    thread.join()
+    return aggregator.count / elapsed
+
+
+def bench_receive():
+    """ Packets/sec handled by the UDP server for each receive mode """
+    duration = .2 if ONCE else 3
+    for batch_size in (1, dogstatsd.RECV_BATCH_SIZE):
+        rate = _receive_rate(18125, duration, batch_size=batch_size)
+        report('receive batch_size=%d' % batch_size, rate, 'packets/s')
+    rate = _receive_rate(18125, duration, queue_size=4096)
+    report('receive queue_size=4096', rate, 'packets/s')
+
+
+def _tagged_lines(count):
+    """ Lines shaped like our production traffic """
+    lines = []
+    for i in range(count):
+        lines.append('service.request.duration:%d.%d|ms|@0.5|#env:prod,service:web%d,'
+                     'endpoint:/api/v1/items,status:200' % (i, i % 10, i % 20))
+        lines.append('service.request.count:1|c|#env:prod,service:web%d,status:200' % (i % 20))
+        lines.append('service.queue.depth:%d|g|#env:prod,queue:jobs%d' % (i, i % 5))
+    return lines
+
+
+def _parse_rate(parse, lines, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        for line in lines:
+            parse(line)
+    return len(lines) * repeat / (time.time() - start)
+
+
+def bench_parse():
+    """ Lines/sec through the single value fast path and the general parser """
+    aggregator = MetricsBucketAggregator(None, 10)
+    lines = _tagged_lines(100)
+    repeat = 1 if ONCE else 300
+    for parse in (aggregator.parse_multi_metric_packet, aggregator.parse_metric_packet):
+        report('parse %s' % parse.__name__, _parse_rate(parse, lines, repeat), 'lines/s')
+
+
+def bench_submit():
+    """ Lines/sec through submit_packets, with and without the context cache """
+    packets = '\n'.join(_tagged_lines(100))
+    repeat = 1 if ONCE else 300
+    for cache_size in (0, 16384):
+        aggregator = MetricsBucketAggregator(None, 10, utf8_decoding=True,
+                                             context_cache_size=cache_size)
+        start = time.time()
+        for _ in xrange(repeat):
+            aggregator.submit_packets(packets)
+        report('submit context_cache_size=%d' % cache_size,
+               aggregator.count / (time.time() - start), 'lines/s')
+
+
+def _datagrams(count):
+    """ Datagrams packed with 20 to 50 lines each, like our clients send """
+    lines = _tagged_lines(500)
+    datagrams = []
+    pos = 0
+    for i in range(count):
+        size = 20 + i % 31
+        datagrams.append('\n'.join(lines[pos:pos + size]))
+        pos = (pos + size) % (len(lines) - 50)
+    return datagrams
+
+
+def bench_datagrams():
+    """ Lines/sec scanned and submitted from packed datagrams """
+    aggregator = MetricsBucketAggregator(None, 10, utf8_decoding=True)
+    datagrams = _datagrams(100)
+    lines = sum(d.count('\n') + 1 for d in datagrams)
+    repeat = 1 if ONCE else 50
+
+    def split_lines(datagram):
+        for line in datagram.splitlines():
+            aggregator.split_metric_packet(line)
+
+    def scan(datagram):
+        for match in METRIC_LINE.finditer(datagram):
+            match.groups()
+
+    for name, run in (('split lines', split_lines), ('scan', scan),
+                      ('submit_packets', aggregator.submit_packets)):
+        start = time.time()
+        for _ in xrange(repeat):
+            for datagram in datagrams:
+                run(datagram)
+        report('datagrams %s' % name, lines * repeat / (time.time() - start), 'lines/s')
+
+
+def bench_histogram():
+    """ Time to sample and flush a histogram, by samples per interval """
+    sizes = (1000,) if ONCE else (10000, 100000, 1000000)
+    for size in sizes:
+        values = [random.lognormvariate(3, 1) for _ in xrange(size)]
+        histogram = Histogram(api_formatter, ('latency', (), None, None))
+        start = time.time()
+        for value in values:
+            histogram.sample(value, 1)
+        sampled = time.time()
+        histogram.flush(1000, 10)
+        report('histogram sample %d' % size, size / (sampled - start), 'samples/s')
+        report('histogram flush %d' % size, (time.time() - sampled) * 1000, 'ms')
+
+
+def bench_flush():
+    """ Flush time with many known counters, few of them sampled per interval """
+    known = 1000 if ONCE else 100000
+    aggregator = MetricsBucketAggregator(None, 10, context_cache_size=0)
+    now = [1000.0]
+    aggregator_module.time = lambda: now[0]
+    try:
+        aggregator.submit_packets('\n'.join('requests:1|c|#id:%d' % i for i in xrange(known)))
+        now[0] += 10
+        aggregator.flush()
+        active = '\n'.join('requests:1|c|#id:%d' % i for i in xrange(known / 10))
+        elapsed = 0
+        for _ in xrange(5):
+            aggregator.submit_packets(active)
+            now[0] += 10
+            start = time.time()
+            aggregator.flush()
+            elapsed += time.time() - start
+    finally:
+        aggregator_module.time = time.time
+    report('flush %d known counters, 10%% sampled' % known, elapsed / 5 * 1000, 'ms')
+
+
+def bench_flush_engines():
+    """ Flush time of every context sampled, by aggregator """
+    contexts = 1000 if ONCE else 500000
+    packets = '\n'.join('requests:1|c|#id:%d\nqueue.depth:%d|g|#id:%d' % (i, i, i)
+                         for i in xrange(contexts / 2))
+    for aggregator_class in (MetricsBucketAggregator, ColumnarAggregator):
+        aggregator = aggregator_class(None, 10, context_cache_size=0)
+        now = [1000.0]
+        aggregator_module.time = lambda: now[0]
+        try:
+            elapsed = 0
+            for _ in xrange(3):
+                aggregator.submit_packets(packets)
+                now[0] += 10
+                start = time.time()
+                aggregator.flush()
+                elapsed += time.time() - start
+        finally:
+            aggregator_module.time = time.time
+        report('flush %d contexts %s' % (contexts, aggregator_class.__name__),
+               elapsed / 3 * 1000, 'ms')
+
+
+def _resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _context_memory(mtype, count, conn):
+    aggregator = MetricsBucketAggregator(None, 10, context_cache_size=0)
+    lines = ['app.metric%d:1|%s|#env:prod,service:web%d' % (i % 100, mtype, i)
+             for i in xrange(count)]
+    packets = '\n'.join(lines)
+    del lines
+    before = _resident_bytes()
+    aggregator.submit_packets(packets)
+    conn.send((_resident_bytes() - before) / float(count))
+
+
+def bench_memory():
+    """ Resident bytes per live context, for each metric type """
+    count = 2000 if ONCE else 200000
+    for mtype in ('g', 'c', 'ms', 's'):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_context_memory,
+                                          args=(mtype, count, child))
+        process.start()
+        report('memory per %s context' % mtype, parent.recv(), 'bytes')
+        process.join()
+
+
+BENCHMARKS = [
+    bench_receive,
+    bench_parse,
+    bench_submit,
+    bench_datagrams,
+    bench_histogram,
+    bench_flush,
+    bench_flush_engines,
+    bench_memory,
+]
+
+
+def main(argv):
+    global ONCE
+    args = argv[1:]
+    if args and args[0] == 'once':
+        ONCE = True
+        args = args[1:]
+    log.setLevel(logging.WARN)
+    for benchmark in BENCHMARKS:
+        if not args or benchmark.__name__ in args:
+            benchmark()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
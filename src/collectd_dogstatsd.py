@@ -41,8 +41,13 @@ class Logger(object):
 DOG_STATSD_TYPE_TO_COLLECTD_TYPE = {
     "gauge": "gauge",
     "rate": "absolute",
+    "count": "absolute",
 }
 
+# Prefix of the metrics the plugin reports about itself
+INTERNAL_METRIC_PREFIX = "dogstatsd."
+INTERNAL_PLUGIN_INSTANCE = "internal"
+
 
 # pylint: disable=too-few-public-methods,too-many-instance-attributes
 class DogstatsDConfig(object):
@@ -58,7 +63,28 @@ class DogstatsDConfig(object):
         self.api_token = ""
         self.log = log
         self.collectd_send = False
-
+        self.batch_size = dogstatsd.RECV_BATCH_SIZE
+        self.listeners = 1
+        self.queue_size = 0
+        self.drop_policy = dogstatsd.DROP_NEWEST
+        self.socket_path = None
+        self.tcp_port = None
+        self.receive_buffer = None
+        self.forward_host = None
+        self.forward_port = None
+        self.forward_packet_size = dogstatsd.FORWARD_PACKET_SIZE
+        self.workers = 0
+        self.context_cache_size = dogstatsd.CONTEXT_CACHE_SIZE
+        self.max_contexts_per_metric = 0
+        self.max_contexts = 0
+        self.metric_filter = None
+        self.shed_sample_rate = 0
+        self.sketch_histograms = []
+        self.approximate_sets = []
+        self.set_precision = dogstatsd.HLL_PRECISION
+        self.columnar = False
+
+    # pylint: disable=too-many-branches,too-many-statements
     def configure_callback(self, conf):
         self.log.info("Configure callback")
         for node in conf.children:
@@ -80,9 +106,69 @@ class DogstatsDConfig(object):
                 self.api_token = node.values[0]
             elif node.key == "collectdsend":
                 self.collectd_send = bool(node.values[0])
+            elif node.key == "BatchSize":
+                self.batch_size = int(node.values[0])
+            elif node.key == "Listeners":
+                self.listeners = int(node.values[0])
+            elif node.key == "QueueSize":
+                self.queue_size = int(node.values[0])
+            elif node.key == "QueueDropPolicy":
+                self.drop_policy = node.values[0].lower()
+            elif node.key == "SocketPath":
+                self.socket_path = node.values[0]
+            elif node.key == "TCPPort":
+                self.tcp_port = int(node.values[0])
+            elif node.key == "ReceiveBuffer":
+                self.receive_buffer = int(node.values[0])
+            elif node.key == "ForwardHost":
+                self.forward_host = node.values[0]
+            elif node.key == "ForwardPort":
+                self.forward_port = int(node.values[0])
+            elif node.key == "ForwardPacketSize":
+                self.forward_packet_size = int(node.values[0])
+            elif node.key == "Workers":
+                self.workers = int(node.values[0])
+            elif node.key == "ContextCacheSize":
+                self.context_cache_size = int(node.values[0])
+            elif node.key == "MaxContextsPerMetric":
+                self.max_contexts_per_metric = int(node.values[0])
+            elif node.key == "MaxContexts":
+                self.max_contexts = int(node.values[0])
+            elif node.key == "ShedSampleRate":
+                self.shed_sample_rate = float(node.values[0])
+            elif node.key == "SketchHistograms":
+                self.sketch_histograms.extend(node.values)
+            elif node.key == "ApproximateSets":
+                self.approximate_sets.extend(node.values)
+            elif node.key == "SetPrecision":
+                self.set_precision = int(node.values[0])
+            elif node.key == "Columnar":
+                self.columnar = bool(node.values[0])
+            elif node.key == "MetricFilter":
+                self.metric_filter = self.parse_metric_filter(node)
             # else:
             #     self.log.warning('Unknown config key: %s' % node.key)
 
+    def parse_metric_filter(self, conf):
+        rules = {
+            "Allow": [], "Deny": [], "Rename": [],
+            "AllowTag": [], "DenyTag": [], "RenameTag": [],
+        }
+        for node in conf.children:
+            if node.key not in rules:
+                self.log.warning("Unknown MetricFilter rule: %s" % node.key)
+            elif node.key.startswith("Rename"):
+                if len(node.values) != 2:
+                    self.log.warning("%s takes 2 values" % node.key)
+                else:
+                    rules[node.key].append(tuple(node.values))
+            else:
+                rules[node.key].extend(node.values)
+        return dogstatsd.MetricFilter(
+            allow=rules["Allow"], deny=rules["Deny"], rename=rules["Rename"],
+            allow_tags=rules["AllowTag"], deny_tags=rules["DenyTag"],
+            rename_tags=rules["RenameTag"])
+
 
 def filter_signalfx_dimension(dogstatsddim):
     invalid_chars = "[],=:"
@@ -126,7 +212,7 @@ class SignalfxPointSender(object):
         self.sfx = signalfx.SignalFx(config.api_token,
                                      ingest_endpoint=config.ingest_endpoint)
 
-    def send_points(self, metrics):
+    def send_points(self, metrics, plugin_instance=None):
         gauges = []
         counters = []
         for metric in metrics:
@@ -141,6 +227,8 @@ class SignalfxPointSender(object):
 
             sfx_metric["metric"] = metric['metric']
             sfx_metric["dimensions"] = dims_from_tags(metric['tags'])
+            if plugin_instance is not None:
+                sfx_metric["dimensions"]["plugin_instance"] = plugin_instance
             sfx_metric["timestamp"] = int(metric['points'][0][0] * 1000)
             sfx_metric["value"] = metric['points'][0][1]
             if metric['type'] == "rate":
@@ -162,7 +250,7 @@ class CollectDPointSender(object):
         self.log = log
         self.plugin = plugin
 
-    def send_points(self, metrics):
+    def send_points(self, metrics, plugin_instance=None):
         for metric in metrics:
             val = self.Values(plugin=self.plugin, meta={'0': True})
 
@@ -173,6 +261,8 @@ class CollectDPointSender(object):
 
             val.type_instance = metric['metric']
             val.plugin_instance = combine_dims(dims_from_tags(metric['tags']))
+            if plugin_instance is not None:
+                val.plugin_instance = plugin_instance + val.plugin_instance
             val.values = [metric['points'][0][1]]
             if metric['type'] == "rate":
                 val.values[0] *= self.config.aggregator_interval
@@ -189,6 +279,8 @@ class DogstatsDCollectD(object):
         self.log = Logger(collectd_module)
         self.plugin = plugin
         self.server = None
+        self.servers = []
+        self.send_duration = 0
         self.config = DogstatsDConfig(self.log)
         self.sender = CollectDPointSender(self.config, collectd_module.Values,
                                           self.plugin, self.log)
@@ -204,34 +296,105 @@ class DogstatsDCollectD(object):
     def read_callback(self):
         if self.server is None:
             return
-        metrics = self.server.metrics_aggregator.flush()
+        started = time.time()
+        aggregator = self.server.metrics_aggregator
+        for shard in self.servers[1:]:
+            # Servers feeding a WorkerPool all share it
+            if shard.metrics_aggregator is not aggregator:
+                aggregator.merge_from(shard.metrics_aggregator)
+        metrics = aggregator.flush()
+        flushed = time.time()
         self.sender.send_points(metrics)
+        self.send_duration = time.time() - flushed
+        self.sender.send_points(self.internal_metrics(flushed - started),
+                                plugin_instance=INTERNAL_PLUGIN_INSTANCE)
+
+    def internal_metrics(self, flush_duration=0):
+        """
+        Points about the plugin itself.  When there are several listeners
+        each one's stats are tagged with its index.
+        """
+        stats = [
+            ('flush.duration', flush_duration, 'gauge', None),
+            ('send.duration', self.send_duration, 'gauge', None),
+        ]
+        aggregator = self.server.metrics_aggregator
+        for index, server in enumerate(self.servers):
+            server_stats = server.flush_stats()
+            if index == 0 or server.metrics_aggregator is not aggregator:
+                server_stats += server.metrics_aggregator.flush_stats()
+            if len(self.servers) > 1:
+                listener_tag = ('listener:%d' % index,)
+                server_stats = [
+                    (name, value, mtype, (tags or ()) + listener_tag)
+                    for name, value, mtype, tags in server_stats]
+            stats.extend(server_stats)
+
+        timestamp = time.time()
+        return [{
+            'metric': INTERNAL_METRIC_PREFIX + name,
+            'points': [(timestamp, value)],
+            'tags': tags,
+            'host': None,
+            'device_name': None,
+            'type': mtype,
+            'interval': self.config.aggregator_interval,
+        } for name, value, mtype, tags in stats]
 
     def init_callback(self):
         self.log.info("plugin init %s" % self.config)
         if self.config.verbose_logging is True:
             self.log.verbose_logging = True
         assert self.server is None
-        if self.config.listen_port is None:
+        if self.config.listen_port is None and \
+                self.config.socket_path is None and \
+                self.config.tcp_port is None:
             self.log.info("dogstatsd port listening not enabled")
             return
         if not self.config.collectd_send:
             self.sender = SignalfxPointSender(self.config, self.log)
 
-        self.server = dogstatsd.init(
+        self.servers = dogstatsd.init(
             self.config.listen_ip, self.config.listen_port,
             timeout=self.config.udp_timeout,
-            aggregator_interval=self.config.aggregator_interval)
-        udp_server_thread = threading.Thread(target=self.server.start)
-        udp_server_thread.daemon = True
-        udp_server_thread.start()
+            aggregator_interval=self.config.aggregator_interval,
+            batch_size=self.config.batch_size,
+            listeners=self.config.listeners,
+            queue_size=self.config.queue_size,
+            drop_policy=self.config.drop_policy,
+            socket_path=self.config.socket_path,
+            tcp_port=self.config.tcp_port,
+            receive_buffer=self.config.receive_buffer,
+            forward_to_host=self.config.forward_host,
+            forward_to_port=self.config.forward_port,
+            forward_packet_size=self.config.forward_packet_size,
+            workers=self.config.workers,
+            context_cache_size=self.config.context_cache_size,
+            max_contexts_per_metric=self.config.max_contexts_per_metric,
+            max_contexts=self.config.max_contexts,
+            metric_filter=self.config.metric_filter,
+            shed_sample_rate=self.config.shed_sample_rate,
+            sketch_histograms=self.config.sketch_histograms,
+            approximate_sets=self.config.approximate_sets,
+            set_precision=self.config.set_precision,
+            columnar=self.config.columnar)
+        self.server = self.servers[0]
+        for server in self.servers:
+            udp_server_thread = threading.Thread(target=server.start)
+            udp_server_thread.daemon = True
+            udp_server_thread.start()
 
     def register_shutdown(self):
         self.log.info("shutting down plugin")
         if self.server is None:
             return
-        self.server.stop()
-        while not self.server.start_has_finished.acquire(False):
-            time.sleep(.01)
-        self.server.start_has_finished.release()
+        for server in self.servers:
+            server.stop()
+        # stop() wakes the servers up, so this doesn't wait for a timeout
+        for server in self.servers:
+            server.start_has_finished.acquire()
+            server.start_has_finished.release()
+        if isinstance(self.server.metrics_aggregator, dogstatsd.WorkerPool):
+            self.server.metrics_aggregator.stop()
         self.server = None
+        self.servers = []
@@ -40,17 +40,26 @@ A Python Statsd implementation with some datadog special sauce.
 """
 
 # stdlib
+import errno
+import fcntl
+import functools
 import logging
+import multiprocessing
 import os
+import Queue
 import select
+import signal
 import socket
+import stat
+import sys
+import time
 import zlib
 
 import simplejson as json
 
 # project
-from aggregator import MetricsBucketAggregator, DEFAULT_HISTOGRAM_AGGREGATES, \
-    DEFAULT_HISTOGRAM_PERCENTILES
+from aggregator import ColumnarAggregator, MetricsBucketAggregator, MetricFilter, MetricTypes, CONTEXT_CACHE_SIZE, \
+    DEFAULT_HISTOGRAM_AGGREGATES, DEFAULT_HISTOGRAM_PERCENTILES, HLL_PRECISION
 
 
 # urllib3 logs a bunch of stuff at the info level
@@ -67,6 +76,34 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# Maximum number of datagrams read from the socket per select wakeup
+RECV_BATCH_SIZE = 64
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+# What to discard when the receive queue is full
+DROP_NEWEST = 'newest'
+DROP_OLDEST = 'oldest'
+# TCP listener: pending connections, read size and longest line accepted
+STREAM_BACKLOG = 128
+STREAM_RECV_SIZE = 64 * 1024
+MAX_LINE_LENGTH = 64 * 1024
+# Where Linux accounts for the datagrams dropped on full receive buffers
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+# Forwarding: batches of datagrams waiting to be sent, and the largest
+# datagram to pack lines into (fits an ethernet MTU)
+FORWARD_QUEUE_SIZE = 1024
+FORWARD_PACKET_SIZE = 1432
+# Parsing workers: batches of lines waiting per worker, and how long a flush
+# waits for each worker to answer
+WORKER_QUEUE_SIZE = 1024
+WORKER_FLUSH_TIMEOUT = 5
+# Load shedding starts above the high watermark and stops below the low one,
+# load being the fill ratio of the receive queue, or without one the share
+# of time the receive loop spent busy over each SHED_WINDOW seconds
+SHED_HIGH_WATERMARK = .8
+SHED_LOW_WATERMARK = .5
+SHED_WINDOW = 1
+# Python 2 does not expose SO_REUSEPORT, fall back on the Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
@@ -91,53 +128,442 @@ def serialize_event(event):
     return json.dumps(event)
 
 
+def per_second(delta, elapsed):
+    if elapsed <= 0:
+        return 0
+    return delta / float(elapsed)
+
+
+def socket_drops(sock):
+    """
+    Number of datagrams the kernel dropped for a UDP socket because its
+    receive buffer was full, or None if that isn't available (not Linux, or
+    the socket is closed).
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, socket.error):
+        return None
+    for path in PROC_NET_UDP:
+        try:
+            with open(path) as proc_net_udp:
+                proc_net_udp.readline()
+                for line in proc_net_udp:
+                    fields = line.split()
+                    # sl local rem st tx:rx tr:when retrnsmt uid timeout inode ref pointer drops
+                    if len(fields) > 12 and fields[9] == inode:
+                        return int(fields[12])
+        except IOError:
+            continue
+    return None
+
+
+class PacketRing(object):
+    """
+    A bounded ring of preallocated receive buffers between the thread reading
+    the socket and the thread parsing the datagrams.
+
+    The reader receives into a spare buffer and swaps it with a free slot in
+    ``put``, so datagrams are never copied on the receive side.  When the ring
+    is full the DROP_NEWEST policy discards the incoming datagram and
+    DROP_OLDEST overwrites the oldest queued one.
+    """
+
+    def __init__(self, capacity, slot_size, policy=DROP_NEWEST):
+        if policy not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError('Unknown drop policy: %s' % policy)
+        self.capacity = int(capacity)
+        self.slot_size = slot_size
+        self.policy = policy
+        self.slots = [bytearray(slot_size) for _ in xrange(self.capacity)]
+        self.lengths = [0] * self.capacity
+        self.head = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+
+    def new_buffer(self):
+        return bytearray(self.slot_size)
+
+    def put(self, buf, nbytes):
+        """
+        Queue the first ``nbytes`` of ``buf`` and return the buffer the caller
+        should receive the next datagram into.
+        """
+        capacity = self.capacity
+        with self.lock:
+            if self.depth == capacity:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return buf
+                idx = self.head
+                self.head = (idx + 1) % capacity
+            else:
+                idx = (self.head + self.depth) % capacity
+                self.depth += 1
+                if self.depth > self.max_depth:
+                    self.max_depth = self.depth
+                if self.depth == 1:
+                    self.not_empty.notify()
+            spare = self.slots[idx]
+            self.slots[idx] = buf
+            self.lengths[idx] = nbytes
+        return spare
+
+    def get_batch(self, max_items):
+        """
+        Wait for queued datagrams and return up to ``max_items`` of them as
+        strings.  Returns an empty list once the ring is closed and drained.
+        """
+        capacity = self.capacity
+        slots = self.slots
+        lengths = self.lengths
+        batch = []
+        with self.lock:
+            while not self.depth and not self.closed:
+                self.not_empty.wait()
+            for _ in xrange(min(self.depth, max_items)):
+                idx = self.head
+                # Not memoryview, Python 2.6 doesn't have it
+                batch.append(bytes(slots[idx][:lengths[idx]]))
+                self.head = (idx + 1) % capacity
+                self.depth -= 1
+        return batch
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+
+
+class Forwarder(object):
+    """
+    Forwards the datagrams received by a server to another statsd server from
+    a thread of its own, so a slow or blocking send never holds up receiving.
+
+    Batches of datagrams wait in a bounded queue (and are dropped when it is
+    full), and their lines are packed into datagrams of up to
+    ``max_packet_size`` bytes before being sent.
+    """
+
+    def __init__(self, host, port, queue_size=FORWARD_QUEUE_SIZE, max_packet_size=FORWARD_PACKET_SIZE):
+        self.address = (host, int(port))
+        self.max_packet_size = max_packet_size
+        self.queue = Queue.Queue(queue_size)
+        self.socket = None
+        self.thread = None
+        # Cumulative, flush_stats reports the difference since the last call.
+        # Each is only written by one thread: dropped by the receiving one,
+        # the others by the forwarding one.
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.send_dropped = 0
+        self.last_stats = (0, 0, 0)
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(self.address)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.socket.close()
+
+    def forward(self, batch):
+        """ Queue a list of datagrams to be forwarded. """
+        try:
+            self.queue.put_nowait(batch)
+        except Queue.Full:
+            self.dropped += len(batch)
+
+    def _run(self):
+        queue_get = self.queue.get
+        queue_get_nowait = self.queue.get_nowait
+        send = self._send
+        max_packet_size = self.max_packet_size
+        stopping = False
+        while not stopping:
+            # Block for a batch, then take whatever else is already queued so
+            # bursts go out in as few packets as possible.
+            batches = [queue_get()]
+            try:
+                while True:
+                    batches.append(queue_get_nowait())
+            except Queue.Empty:
+                pass
+
+            packet = []
+            size = 0
+            for batch in batches:
+                if batch is None:
+                    stopping = True
+                    break
+                for message in batch:
+                    if packet and size + 1 + len(message) > max_packet_size:
+                        send(packet)
+                        packet = []
+                        size = 0
+                    size += len(message) + (1 if packet else 0)
+                    packet.append(message)
+            if packet:
+                send(packet)
+
+    def _send(self, packet):
+        try:
+            self.socket.send('\n'.join(packet))
+            self.sent += 1
+            if len(packet) > 1:
+                self.coalesced += len(packet)
+        except socket.error:
+            log.debug('Error forwarding packet', exc_info=True)
+            self.send_dropped += len(packet)
+
+    def flush_stats(self):
+        current = (self.sent, self.coalesced, self.dropped + self.send_dropped)
+        last = self.last_stats
+        self.last_stats = current
+        return [
+            ('forward.sent', current[0] - last[0], MetricTypes.COUNT, None),
+            ('forward.coalesced', current[1] - last[1], MetricTypes.COUNT, None),
+            ('forward.dropped', current[2] - last[2], MetricTypes.COUNT, None),
+        ]
+
+
+class Poller(object):
+    """
+    Read readiness for a set of file descriptors, a minimal stand-in for the
+    Python 3 selectors module: epoll where available, poll otherwise.  Idle
+    descriptors cost nothing per wakeup, unlike with select.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._events = select.EPOLLIN
+            self._timeout_scale = 1
+        else:
+            self._poller = select.poll()
+            self._events = select.POLLIN
+            self._timeout_scale = 1000
+
+    def register(self, fd):
+        self._poller.register(fd, self._events)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        """ Wait up to ``timeout`` seconds and return the readable fds. """
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout *= self._timeout_scale
+        return [fd for fd, _ in self._poller.poll(timeout)]
+
+    def close(self):
+        close = getattr(self._poller, 'close', None)
+        if close is not None:
+            close()
+
+
+class Waker(object):
+    """
+    A pipe registered with a poller next to the sockets, so that another
+    thread can interrupt the wait at once instead of after the timeout.
+    Waking and closing are locked, so a closed waker, whose fds may already
+    belong to another file, is never written to.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.closed = False
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.read_fd
+
+    def wake(self):
+        with self.lock:
+            if self.closed:
+                # The poller has already stopped
+                return
+            try:
+                os.write(self.write_fd, '\0')
+            except OSError, e:
+                # A full pipe will wake the poller just the same
+                if e.errno not in WOULD_BLOCK:
+                    raise
+
+    def consume(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in WOULD_BLOCK:
+                raise
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+
+
+class LoadShedder(object):
+    """
+    Samples the histogram, timer and distribution lines of an aggregator,
+    keeping a ``sample_rate`` share of them, while the server feeding it is
+    behind.
+    Counters and gauges stay exact.  Shedding starts when the load reaches
+    ``high`` and only stops when it falls back to ``low``, so it doesn't
+    flap around a single threshold.
+    """
+
+    def __init__(self, metrics_aggregator, sample_rate, high=SHED_HIGH_WATERMARK, low=SHED_LOW_WATERMARK):
+        self.metrics_aggregator = metrics_aggregator
+        self.sample_rate = sample_rate
+        self.high = high
+        self.low = low
+        self.shedding = False
+        metrics_aggregator.load_shedding = True
+
+    def update(self, load):
+        if not self.shedding and load >= self.high:
+            log.warning('Falling behind (load %.2f), keeping %s of the histogram and timer samples' %
+                        (load, self.sample_rate))
+            self.shedding = True
+            self.metrics_aggregator.shed_sample_rate = self.sample_rate
+        elif self.shedding and load <= self.low:
+            log.info('Caught up (load %.2f), keeping all the samples again' % load)
+            self.shedding = False
+            self.metrics_aggregator.shed_sample_rate = 1
+
+
 class Server(object):
     """
     A statsd udp server.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, timeout=UDP_SOCKET_TIMEOUT):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, timeout=UDP_SOCKET_TIMEOUT,
+                 batch_size=RECV_BATCH_SIZE, reuse_port=False, queue_size=0, drop_policy=DROP_NEWEST,
+                 socket_path=None, receive_buffer=None, forward_packet_size=FORWARD_PACKET_SIZE,
+                 shed_sample_rate=0):
         self.host = host
-        self.port = int(port)
+        # Without a port we only listen on the unix socket
+        self.port = int(port) if port is not None else None
         self.address = (self.host, self.port)
+        self.socket_path = socket_path
+        self.receive_buffer = receive_buffer
+        # Running totals for flush_stats
+        self.bytes_received = 0
+        self.wakeups = 0
+        self.busy_time = 0.0
+        self.max_busy_time = 0.0
+        self.last_stats = (time.time(), 0, 0, 0.0)
+        self.last_socket_drops = 0
+        self.last_ring_drops = 0
         self.metrics_aggregator = metrics_aggregator
         self.buffer_size = 1024 * 8
+        self.batch_size = max(1, int(batch_size))
+        self.reuse_port = reuse_port
         self.start_has_finished = threading.Semaphore()
         self.shouldStop = threading.Event()
         self.running = threading.Event()
         self.socket = None
+        self.unix_socket = None
+        self.sockets = []
+        self.waker = None
         self.timeout = timeout
 
+        # With a queue, the receiving thread only fills the ring and a second
+        # thread does the parsing, so a slow parse can't overflow the socket.
+        self.ring = None
+        self.recv_buffer = None
+        if queue_size:
+            self.ring = PacketRing(queue_size, self.buffer_size, drop_policy)
+            self.recv_buffer = self.ring.new_buffer()
+
+        self.shedder = None
+        if shed_sample_rate:
+            self.shedder = LoadShedder(metrics_aggregator, shed_sample_rate)
+
         self.should_forward = forward_to_host is not None
 
 
-        self.forward_udp_sock = None
+        self.forwarder = None
         # In case we want to forward every packet received to another statsd server
         if self.should_forward:
             if forward_to_port is None:
                 forward_to_port = 8125
 
             log.info("External statsd forwarding enabled. All packets received will be forwarded to %s:%s" % (forward_to_host, forward_to_port))
-            try:
-                self.forward_udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.forward_udp_sock.connect((forward_to_host, forward_to_port))
-            except Exception:
-                log.exception("Error while setting up connection to external statsd server")
+            self.forwarder = Forwarder(forward_to_host, forward_to_port, max_packet_size=forward_packet_size)
 
     def start(self):
+        self.start_has_finished.acquire()
         try:
-            self.start_has_finished.acquire()
-            self._start()
+            self._serve()
         finally:
-            self.socket.close()
+            # Whatever happened, shutdown waits on this
             self.start_has_finished.release()
 
-    def _start(self):
-        """ Run the server. """
+    def _serve(self):
+        parser = None
+        try:
+            if self.forwarder is not None:
+                try:
+                    self.forwarder.start()
+                except Exception:
+                    log.exception("Error while setting up connection to external statsd server")
+                    self.forwarder = None
+                    self.should_forward = False
+            if self.ring is not None:
+                parser = threading.Thread(target=self._parse_queued)
+                parser.daemon = True
+                parser.start()
+            self.waker = Waker()
+            self._start()
+        finally:
+            if self.waker is not None:
+                waker, self.waker = self.waker, None
+                waker.close()
+            if parser is not None:
+                self.ring.close()
+                parser.join()
+            if self.forwarder is not None:
+                self.forwarder.stop()
+            for sock in self.sockets:
+                sock.close()
+            if self.unix_socket is not None:
+                try:
+                    os.unlink(self.socket_path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def _bind_udp(self):
         # Bind to the UDP socket.
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sockets.append(self.socket)
         self.socket.setblocking(0)
+        self._set_receive_buffer(self.socket)
+        if self.reuse_port:
+            # Every listener of a pool binds the same port, the kernel spreads
+            # the datagrams between them by source address.
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         try:
             self.socket.bind(self.address)
         except socket.gaierror:
@@ -148,53 +574,578 @@ class Server(object):
 
         log.info('Listening on host & port: %s' % str(self.address))
 
+    def _bind_unix(self):
+        # Local clients block on a full unix socket rather than losing
+        # datagrams, and skip the UDP/IP stack altogether.
+        path = self.socket_path
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            log.info('Removing stale socket %s' % path)
+            os.unlink(path)
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sockets.append(unix_socket)
+        unix_socket.setblocking(0)
+        self._set_receive_buffer(unix_socket)
+        unix_socket.bind(path)
+        self.unix_socket = unix_socket
+
+        log.info('Listening on unix socket: %s' % path)
+
+    def _set_receive_buffer(self, sock):
+        if not self.receive_buffer:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        # Linux doubles the value for its own bookkeeping, and caps it to
+        # net.core.rmem_max
+        actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if actual < self.receive_buffer:
+            log.warning('Receive buffer is %d bytes instead of %d, check net.core.rmem_max' %
+                        (actual, self.receive_buffer))
+        else:
+            log.info('Receive buffer is %d bytes' % actual)
+
+    def flush_stats(self):
+        """
+        Internal metrics about the server since the previous call, as a list
+        of (name, value, metric_type, tags).
+        """
+        cur_time = time.time()
+        current = (cur_time, self.bytes_received, self.wakeups, self.busy_time)
+        last = self.last_stats
+        self.last_stats = current
+        wakeups = current[2] - last[2]
+
+        stats = [
+            ('bytes_per_second', per_second(current[1] - last[1], cur_time - last[0]), MetricTypes.GAUGE, None),
+            # Time spent handling each wakeup of the receive loop
+            ('receive.latency.avg', per_second(current[3] - last[3], wakeups), MetricTypes.GAUGE, None),
+            ('receive.latency.max', self.max_busy_time, MetricTypes.GAUGE, None),
+        ]
+        self.max_busy_time = 0.0
+
+        if self.ring is not None:
+            ring = self.ring
+            dropped = ring.dropped
+            stats += [
+                ('queue.depth', ring.depth, MetricTypes.GAUGE, None),
+                ('queue.max_depth', ring.max_depth, MetricTypes.GAUGE, None),
+                ('queue.drops', dropped - self.last_ring_drops, MetricTypes.COUNT, None),
+            ]
+            ring.max_depth = ring.depth
+            self.last_ring_drops = dropped
+
+        if self.socket is not None:
+            drops = socket_drops(self.socket)
+            if drops is not None:
+                stats.append(('udp.receive_drops', drops - self.last_socket_drops, MetricTypes.COUNT, None))
+                self.last_socket_drops = drops
+        if self.forwarder is not None:
+            stats += self.forwarder.flush_stats()
+        return stats
+
+    def _start(self):
+        """ Run the server. """
+        if self.port is not None:
+            self._bind_udp()
+        if self.socket_path is not None:
+            self._bind_unix()
+        self.running.set()
+
+        poller = Poller()
+        sockets_by_fd = {}
+        for sock in self.sockets:
+            sockets_by_fd[sock.fileno()] = sock
+            poller.register(sock.fileno())
+        waker_fd = self.waker.fileno()
+        poller.register(waker_fd)
+        try:
+            self._loop(poller, sockets_by_fd, waker_fd)
+        finally:
+            poller.close()
+
+    def _loop(self, poller, sockets_by_fd, waker_fd):
         # Inline variables for quick look-up.
-        buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
-        select_select = select.select
-        select_error = select.error
+        poll = poller.poll
+        time_time = time.time
         timeout = self.timeout
-        should_forward = self.should_forward
-        forward_udp_sock = self.forward_udp_sock
+        drain = self._drain_to_ring if self.ring is not None else self._drain
+        # Without a queue, load is how busy the loop is
+        shedder = self.shedder if self.ring is None else None
+        window_start = time_time()
+        window_busy = self.busy_time
 
-        # Run our select loop.
+        # Run our poll loop, stop() wakes it up through the waker.
         while not self.shouldStop.is_set():
             # print "Running is NOT clear ---- %s %s" % (self.running, self.running.isSet())
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
-
-                    if should_forward:
-                        forward_udp_sock.send(message)
-            except select_error, se:
+                ready = poll(timeout)
+                if ready:
+                    started = time_time()
+                    for fd in ready:
+                        if fd == waker_fd:
+                            self.waker.consume()
+                        else:
+                            drain(sockets_by_fd[fd])
+                    busy = time_time() - started
+                    self.wakeups += 1
+                    self.busy_time += busy
+                    if busy > self.max_busy_time:
+                        self.max_busy_time = busy
+                if shedder is not None:
+                    now = time_time()
+                    if now - window_start >= SHED_WINDOW:
+                        shedder.update((self.busy_time - window_busy) / (now - window_start))
+                        window_start = now
+                        window_busy = self.busy_time
+            except (IOError, select.error), se:
                 # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+                if se.args[0] != errno.EINTR:
                     raise
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception:
                 log.exception('Error receiving datagram')
 
+    def _drain(self, sock):
+        """
+        Read the socket until it would block (or the batch is full) and
+        submit everything at once, so a burst of datagrams costs a single
+        select and a single submit instead of one of each per datagram.
+        """
+        socket_recv = sock.recv
+        buffer_size = self.buffer_size
+        batch = []
+        try:
+            for _ in xrange(self.batch_size):
+                batch.append(socket_recv(buffer_size))
+        except socket.error, se:
+            if se[0] not in WOULD_BLOCK:
+                raise
+        finally:
+            if batch:
+                self.bytes_received += sum(map(len, batch))
+                if self.should_forward:
+                    self.forwarder.forward(batch)
+                self.metrics_aggregator.submit_packets('\n'.join(batch))
+
+    def _drain_to_ring(self, sock):
+        """ Like _drain, but only moves the datagrams into the ring. """
+        socket_recv_into = sock.recv_into
+        ring_put = self.ring.put
+        buf = self.recv_buffer
+        received = 0
+        try:
+            for _ in xrange(self.batch_size):
+                nbytes = socket_recv_into(buf)
+                buf = ring_put(buf, nbytes)
+                received += nbytes
+        except socket.error, se:
+            if se[0] not in WOULD_BLOCK:
+                raise
+        finally:
+            self.recv_buffer = buf
+            self.bytes_received += received
+
+    def _parse_queued(self):
+        """
+        Parse (and forward) the datagrams queued in the ring until it is
+        closed.
+        """
+        ring = self.ring
+        get_batch = ring.get_batch
+        batch_size = self.batch_size
+        aggregator_submit = self.metrics_aggregator.submit_packets
+        join = '\n'.join
+        capacity = float(ring.capacity)
+        while True:
+            batch = get_batch(batch_size)
+            if not batch:
+                break
+            if self.shedder is not None:
+                # What's still queued behind this batch
+                self.shedder.update(ring.depth / capacity)
+            if self.should_forward:
+                self.forwarder.forward(batch)
+            try:
+                aggregator_submit(join(batch))
+            except Exception:
+                log.exception('Error parsing datagrams')
+
     def stop(self):
         self.shouldStop.set()
         # print "STOP().  Will clear running %s %s" % (self.running, self.running.isSet())
+        waker = self.waker
+        if waker is not None:
+            waker.wake()
 
 
 
-def init(server_host, port, timeout=UDP_SOCKET_TIMEOUT, aggregator_interval=DOGSTATSD_AGGREGATOR_BUCKET_SIZE):
-    """Configure the server and the reporting thread.
+class StreamServer(object):
+    """
+    A statsd tcp server.  Clients keep persistent connections open and send
+    newline separated metrics; all the connections are served by a single
+    thread polling them, and only complete lines are submitted.
+    """
+
+    def __init__(self, metrics_aggregator, host, port, timeout=UDP_SOCKET_TIMEOUT,
+                 max_line_length=MAX_LINE_LENGTH):
+        self.host = host
+        self.port = int(port)
+        self.address = (self.host, self.port)
+        self.metrics_aggregator = metrics_aggregator
+        self.max_line_length = max_line_length
+        self.start_has_finished = threading.Semaphore()
+        self.shouldStop = threading.Event()
+        self.running = threading.Event()
+        self.socket = None
+        self.timeout = timeout
+        self.poller = None
+        self.waker = None
+        # fd -> [socket, incomplete trailing line]
+        self.connections = {}
+        self.bytes_received = 0
+        self.last_stats = (time.time(), 0)
+
+    def start(self):
+        try:
+            self.start_has_finished.acquire()
+            self._start()
+        finally:
+            for fd in self.connections.keys():
+                self._close(fd)
+            if self.poller is not None:
+                self.poller.close()
+            if self.waker is not None:
+                waker, self.waker = self.waker, None
+                waker.close()
+            if self.socket is not None:
+                self.socket.close()
+            self.start_has_finished.release()
+
+    def _start(self):
+        """ Run the server. """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(0)
+        self.socket.bind(self.address)
+        self.socket.listen(STREAM_BACKLOG)
+        listen_fd = self.socket.fileno()
+
+        self.waker = Waker()
+        waker_fd = self.waker.fileno()
+        self.poller = Poller()
+        self.poller.register(listen_fd)
+        self.poller.register(waker_fd)
+
+        log.info('Listening for tcp connections on host & port: %s' % str(self.address))
+        self.running.set()
+
+        poll = self.poller.poll
+        timeout = self.timeout
+        read = self._read
+
+        while not self.shouldStop.is_set():
+            try:
+                for fd in poll(timeout):
+                    if fd == listen_fd:
+                        self._accept()
+                    elif fd == waker_fd:
+                        self.waker.consume()
+                    else:
+                        read(fd)
+            except (IOError, select.error), se:
+                # Ignore interrupted system calls from sigterm.
+                if se.args[0] != errno.EINTR:
+                    raise
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except Exception:
+                log.exception('Error serving tcp connections')
+
+    def flush_stats(self):
+        cur_time = time.time()
+        current = (cur_time, self.bytes_received)
+        last = self.last_stats
+        self.last_stats = current
+        return [
+            ('tcp.connections', len(self.connections), MetricTypes.GAUGE, None),
+            ('bytes_per_second', per_second(current[1] - last[1], cur_time - last[0]), MetricTypes.GAUGE, None),
+        ]
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.error, se:
+                if se[0] in WOULD_BLOCK:
+                    return
+                raise
+            conn.setblocking(0)
+            self.connections[conn.fileno()] = [conn, '']
+            self.poller.register(conn.fileno())
+
+    def _read(self, fd):
+        connection = self.connections[fd]
+        try:
+            data = connection[0].recv(STREAM_RECV_SIZE)
+        except socket.error, se:
+            if se[0] in WOULD_BLOCK:
+                return
+            log.warning('Error reading tcp connection: %s' % se)
+            data = ''
+
+        if not data:
+            # The peer is done, whatever it sent last is a complete line
+            if connection[1]:
+                self.metrics_aggregator.submit_packets(connection[1])
+            self._close(fd)
+            return
+
+        self.bytes_received += len(data)
+
+        # Only submit up to the last newline and keep the rest for later
+        data = connection[1] + data
+        end = data.rfind('\n')
+        if end == -1:
+            connection[1] = data
+        else:
+            connection[1] = data[end + 1:]
+            self.metrics_aggregator.submit_packets(data[:end])
+
+        if len(connection[1]) > self.max_line_length:
+            log.warning('Closing tcp connection sending a line longer than %d bytes' % self.max_line_length)
+            self._close(fd)
+
+    def _close(self, fd):
+        conn = self.connections.pop(fd)[0]
+        try:
+            self.poller.unregister(fd)
+        except (IOError, KeyError, ValueError):
+            pass
+        conn.close()
+
+    def stop(self):
+        self.shouldStop.set()
+        waker = self.waker
+        if waker is not None:
+            waker.wake()
+
+
+def _worker_main(aggregator_factory, queue, conn, parent_pid):
+    """ Body of a parsing worker process, see WorkerPool. """
+    # Interrupts are for the parent, which stops us through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    metrics_aggregator = aggregator_factory()
+    while True:
+        try:
+            message = queue.get(timeout=1)
+        except Queue.Empty:
+            if os.getppid() != parent_pid:
+                # Orphaned, nobody will ever flush us
+                break
+            continue
+        if message is None:
+            break
+        if isinstance(message, tuple):
+            # ('flush', sequence)
+            conn.send((message[1], metrics_aggregator.flush(),
+                       metrics_aggregator.flush_stats()))
+            continue
+        try:
+            metrics_aggregator.submit_packets(message)
+        except Exception:
+            log.exception('Error parsing datagrams')
+
+
+class WorkerPool(object):
+    """
+    Parses datagrams in separate processes, so that parsing isn't limited to
+    the one core the GIL allows.
+
+    Each line is routed by metric name to one of ``workers`` processes, each
+    running its own aggregator.  Every context thus lives in exactly one
+    worker, and flush() only has to concatenate what the workers flushed.
+    The pool stands in for the aggregator of the servers feeding it.
+
+    A worker found dead by a flush isn't restarted, forking once the other
+    threads run isn't safe: its lines are dropped from then on.
+    """
+
+    def __init__(self, aggregator_factory, workers, queue_size=WORKER_QUEUE_SIZE,
+                 flush_timeout=WORKER_FLUSH_TIMEOUT):
+        self.aggregator_factory = aggregator_factory
+        self.workers = max(1, int(workers))
+        self.queue_size = queue_size
+        self.flush_timeout = flush_timeout
+        self.queues = []
+        self.connections = []
+        self.processes = []
+        # Cleared by flush for the workers found dead
+        self.alive = []
+        self.flush_sequence = 0
+        self.worker_stats = []
+        # Lines handed to the workers, and lines dropped on full queues
+        self.count = 0
+        self.dropped = 0
+        self.last_dropped = 0
+
+    def start(self):
+        """
+        Fork the workers.  Do it before starting any other thread, a child
+        only gets a copy of the forking thread and of whatever locks the
+        others held.
+        """
+        parent_pid = os.getpid()
+        for _ in xrange(self.workers):
+            queue = multiprocessing.Queue(self.queue_size)
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_worker_main,
+                                              args=(self.aggregator_factory, queue, writer, parent_pid))
+            process.daemon = True
+            process.start()
+            writer.close()
+            self.queues.append(queue)
+            self.connections.append(reader)
+            self.processes.append(process)
+            self.alive.append(True)
+        log.info('Started %d parsing workers' % self.workers)
+
+    def stop(self):
+        for queue, process in zip(self.queues, self.processes):
+            if process.is_alive():
+                try:
+                    queue.put_nowait(None)
+                except Queue.Full:
+                    # Terminated below
+                    pass
+        for process in self.processes:
+            process.join(self.flush_timeout)
+            if process.is_alive():
+                log.warning('Parsing worker %d did not stop, terminating it' % process.pid)
+                process.terminate()
+        for queue in self.queues:
+            # Don't wait at exit for lines nobody will read
+            queue.close()
+            queue.cancel_join_thread()
+        for conn in self.connections:
+            conn.close()
+        self.queues = []
+        self.connections = []
+        self.processes = []
+        self.alive = []
+
+    def submit_packets(self, packets):
+        workers = self.workers
+        batches = [[] for _ in xrange(workers)]
+        for line in packets.split('\n'):
+            if line:
+                batches[hash(line.partition(':')[0]) % workers].append(line)
+
+        for queue, alive, lines in zip(self.queues, self.alive, batches):
+            if not lines:
+                continue
+            if not alive:
+                self.dropped += len(lines)
+                continue
+            try:
+                queue.put_nowait('\n'.join(lines))
+                self.count += len(lines)
+            except Queue.Full:
+                self.dropped += len(lines)
+
+    def flush(self):
+        """
+        Flush every worker and return all their metrics.  Whatever a worker
+        too slow to answer the previous flush sent since is included too.
+        """
+        self.flush_sequence += 1
+        sequence = self.flush_sequence
+        requested = []
+        for idx, (queue, process) in enumerate(zip(self.queues, self.processes)):
+            if self.alive[idx] and not process.is_alive():
+                log.error('Parsing worker %d died, its lines are dropped from now on' % idx)
+                self.alive[idx] = False
+            if not self.alive[idx]:
+                requested.append(False)
+                continue
+            # Unlike lines, flush requests wait for room in the queue
+            try:
+                queue.put(('flush', sequence), timeout=self.flush_timeout)
+                requested.append(True)
+            except Queue.Full:
+                log.warning('Parsing worker %d is stalled, not flushing it' % idx)
+                requested.append(False)
+
+        metrics = []
+        self.worker_stats = []
+        for idx, conn in enumerate(self.connections):
+            # Without a request, only take what the worker already sent
+            timeout = self.flush_timeout if requested[idx] else 0
+            answered = False
+            while not answered and conn.poll(timeout):
+                try:
+                    answer_sequence, worker_metrics, stats = conn.recv()
+                except (EOFError, IOError):
+                    # Died
+                    break
+                metrics.extend(worker_metrics)
+                if answer_sequence == sequence:
+                    self.worker_stats.extend(stats)
+                    answered = True
+            if requested[idx] and not answered:
+                log.warning('Parsing worker %d did not flush in %ss' % (idx, self.flush_timeout))
+        return metrics
+
+    def flush_stats(self):
+        """
+        The stats of the workers as of the last flush, added together, and
+        the lines dropped on full worker queues.
+        """
+        totals = {}
+        order = []
+        for name, value, metric_type, tags in self.worker_stats:
+            key = (name, metric_type, tags)
+            if key not in totals:
+                order.append(key)
+                totals[key] = 0
+            totals[key] += value
+        self.worker_stats = []
+
+        dropped = self.dropped
+        stats = [('workers.dropped', dropped - self.last_dropped, MetricTypes.COUNT, None)]
+        self.last_dropped = dropped
+        stats += [(name, totals[(name, metric_type, tags)], metric_type, tags)
+                  for name, metric_type, tags in order]
+        return stats
+
+
+def init(server_host, port, timeout=UDP_SOCKET_TIMEOUT, aggregator_interval=DOGSTATSD_AGGREGATOR_BUCKET_SIZE,
+         batch_size=RECV_BATCH_SIZE, listeners=1, queue_size=0, drop_policy=DROP_NEWEST, socket_path=None,
+         tcp_port=None, receive_buffer=None, forward_to_host=None, forward_to_port=None,
+         forward_packet_size=FORWARD_PACKET_SIZE, workers=0, context_cache_size=CONTEXT_CACHE_SIZE,
+         max_contexts_per_metric=0, max_contexts=0, metric_filter=None, shed_sample_rate=0,
+         sketch_histograms=None, approximate_sets=None, set_precision=HLL_PRECISION, columnar=False):
+    """Configure the servers and their aggregators.
+
+    Returns a list of ``listeners`` servers bound to the same port, each with
+    its own aggregator.  The first aggregator is the one to flush, the others
+    are shards to be merged into it with ``merge_from`` beforehand.  A non-zero
+    ``queue_size`` gives every server a receive ring of that many datagrams.
+    The first server also listens on the unix socket ``socket_path`` if one is
+    given, and ``port`` may be None to listen on that socket only.  With a
+    ``tcp_port``, a StreamServer with an aggregator shard of its own comes last.
+
+    With ``workers``, all the servers share a started WorkerPool of that many
+    processes as their aggregator instead, and there is nothing to merge.
+    A ``shed_sample_rate`` enables load shedding on the UDP servers, except
+    with workers.  With ``columnar``, the aggregators are ColumnarAggregators.
     """
 
     log.debug("Configuring dogstatsd")
 
     hostname = None
 
-    aggregator = MetricsBucketAggregator(
+    aggregator_factory = functools.partial(
+        ColumnarAggregator if columnar else MetricsBucketAggregator,
         hostname,
         aggregator_interval,
         recent_point_threshold=None,
@@ -202,8 +1153,41 @@ def init(server_host, port, timeout=UDP_SOCKET_TIMEOUT, aggregator_interval=DOGS
         histogram_aggregates=DEFAULT_HISTOGRAM_AGGREGATES,
         histogram_percentiles=DEFAULT_HISTOGRAM_PERCENTILES,
         utf8_decoding=True,
+        context_cache_size=context_cache_size,
+        max_contexts_per_metric=max_contexts_per_metric,
+        max_contexts=max_contexts,
+        metric_filter=metric_filter,
+        sketch_histograms=sketch_histograms,
+        approximate_sets=approximate_sets,
+        set_precision=set_precision,
     )
 
-    server = Server(aggregator, server_host, port, timeout=timeout)
+    listeners = max(1, int(listeners))
+    if listeners > 1 and SO_REUSEPORT is None:
+        log.warning("SO_REUSEPORT is not available on this platform, using a single listener")
+        listeners = 1
+
+    if port is None:
+        listeners = 1
+
+    if workers:
+        pool = WorkerPool(aggregator_factory, workers)
+        pool.start()
+        aggregator_factory = lambda: pool
+        if shed_sample_rate:
+            log.warning("Load shedding is not available with parsing workers")
+            shed_sample_rate = 0
+
+    servers = []
+    if port is not None or socket_path is not None:
+        servers += [Server(aggregator_factory(), server_host, port, timeout=timeout, batch_size=batch_size,
+                           reuse_port=listeners > 1, queue_size=queue_size, drop_policy=drop_policy,
+                           socket_path=socket_path if idx == 0 else None, receive_buffer=receive_buffer,
+                           forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                           forward_packet_size=forward_packet_size, shed_sample_rate=shed_sample_rate)
+                    for idx in range(listeners)]
+
+    if tcp_port is not None:
+        servers.append(StreamServer(aggregator_factory(), server_host, tcp_port, timeout=timeout))
 
-    return server
+    return servers
@@ -1,4 +1,12 @@
+# pylint: disable=too-many-lines
 import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import threading
 import time
 from nose.tools import assert_equals
 import aggregator
@@ -24,7 +32,46 @@ def make_config():
     return cfg
 
 
+def is_internal(val):
+    return val.plugin_instance.startswith(
+        collectd_dogstatsd.INTERNAL_PLUGIN_INSTANCE)
+
+
+def user_values(values):
+    return [val for val in values if not is_internal(val)]
+
+
+def internal_values(values):
+    """ type_instance plus any dimensions -> values """
+    prefix = len(collectd_dogstatsd.INTERNAL_PLUGIN_INSTANCE)
+    return dict((val.type_instance + val.plugin_instance[prefix:], val.values)
+                for val in values if is_internal(val))
+
+
+class FakeClock(object):
+    """
+    Stops the aggregator's clock at ``now`` for the length of a with block,
+    setting ``now`` moves it on.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __enter__(self):
+        aggregator.time = self.time
+        return self
+
+    def __exit__(self, *exc_info):
+        aggregator.time = time.time
+
+
+# pylint: disable=too-many-public-methods
 class TestModuleSetup(object):
+    # Added to the config of every module started
+    OPTIONS = []
 
     def __init__(self):
         self.collectd_engine = None
@@ -36,17 +83,18 @@ class TestModuleSetup(object):
         self.collectd_engine.init_logging()
         self.dog_module = collectd_dogstatsd.DogstatsDCollectD(
             self.collectd_engine, register=True)
-        self.dog_module.config.udp_timeout = .1
         aggregator.time = self.time
         self.current_time = time.time()
-        self.collectd_engine.engine_run_config(make_config())
+        cfg = make_config()
+        cfg.children.extend(self.OPTIONS)
+        self.collectd_engine.engine_run_config(cfg)
         self.collectd_engine.engine_run_init()
 
     def tearDown(self):
         self.collectd_engine.engine_run_shutdowns()
         self.collectd_engine = None
         self.dog_module = None
-        aggregator.time = time.time()
+        aggregator.time = time.time
 
     def time(self):
         return self.current_time
@@ -61,14 +109,25 @@ class TestModuleSetup(object):
         logger.warning("warning")
         logger.error("error")
 
-    def _value_setup(self, metrics, expected):
-        self.dog_module.log.verbose_logging = True
-        for metric in metrics:
-            self.dog_module.server.metrics_aggregator.submit_packets(metric)
+    def _send_udp(self, packets, port=1234):
+        self.dog_module.server.running.wait(2)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for packet in packets:
+            sock.sendto(packet, ("127.0.0.1", port))
+        sock.close()
+
+    def _wait_for_count(self, count, metrics_aggregator=None):
+        metrics_aggregator = (metrics_aggregator or
+                              self.dog_module.server.metrics_aggregator)
+        deadline = time.time() + 2
+        while metrics_aggregator.count < count and time.time() < deadline:
+            time.sleep(.01)
+        assert_equals(metrics_aggregator.count, count)
 
+    def _check_expected(self, expected):
         self.current_time += dogstatsd.DOGSTATSD_AGGREGATOR_BUCKET_SIZE
         self.collectd_engine.engine_read_metrics()
-        metrics = self.collectd_engine.dispatched_values
+        metrics = user_values(self.collectd_engine.dispatched_values)
 
         print [s.__str__() for s in metrics]
         assert_equals(len(metrics), len(expected))
@@ -78,6 +137,12 @@ class TestModuleSetup(object):
             assert_equals(metrics[idx].type, exp[2])
             assert_equals(metrics[idx].plugin_instance, exp[3])
 
+    def _value_setup(self, metrics, expected):
+        self.dog_module.log.verbose_logging = True
+        for metric in metrics:
+            self.dog_module.server.metrics_aggregator.submit_packets(metric)
+        self._check_expected(expected)
+
     def test_gauge(self):
         self._value_setup(["fuel.level:0.5|g"],
                           [["fuel.level", [0.5], "gauge", ""]])
@@ -128,3 +193,984 @@ class TestModuleSetup(object):
             [
                 ["users.online", [2], "absolute", "[country=china]"],
             ])
+
+    def test_udp_batch(self):
+        self._send_udp(["page.views:1|c", "page.views:2|c\nfuel.level:0.5|g"])
+        self._wait_for_count(3)
+        self._check_expected([
+            ["page.views", [3], "absolute", ""],
+            ["fuel.level", [0.5], "gauge", ""],
+        ])
+
+    def test_malformed_line(self):
+        self._value_setup(
+            ["page.views:x|c\nfuel.level:0.5|g"],
+            [["fuel.level", [0.5], "gauge", ""]])
+
+    def _start_module(self, port, options):
+        engine = dummy_collectd.DummyCollectd(is_running_tests=True)
+        engine.init_logging()
+        module = collectd_dogstatsd.DogstatsDCollectD(engine, register=True)
+        cfg = make_config()
+        if port is None:
+            del cfg.children[0]
+        else:
+            cfg.children[0].values = [str(port)]
+        for option in self.OPTIONS + options:
+            if isinstance(option, dummy_collectd.Config):
+                cfg.children.append(option)
+            else:
+                cfg.children.append(dummy_collectd.Config(key=option[0],
+                                                          values=[option[1]]))
+        engine.engine_run_config(cfg)
+        engine.engine_run_init()
+        return engine, module
+
+    def test_metric_filter(self):
+        rules = [("Deny", ["debug.*", "*.tmp"]),
+                 ("Rename", ["app.", "service."]),
+                 ("Rename", ["app.web.", "web."]),
+                 ("DenyTag", ["request_id"]),
+                 ("RenameTag", ["dc", "datacenter"])]
+        engine, module = self._start_module(1235, [dummy_collectd.Config(
+            key="MetricFilter", children=[
+                dummy_collectd.Config(key=key, values=values)
+                for key, values in rules])])
+        try:
+            module.server.metrics_aggregator.submit_packets(
+                "debug.loop:1|c\n"
+                "page.tmp:1|c\n"
+                "app.errors:1|c|#dc:east,request_id:1234\n"
+                "app.web.hits:1|c\n"
+                "app.web.hits:1|c")
+            self.current_time += dogstatsd.DOGSTATSD_AGGREGATOR_BUCKET_SIZE
+            engine.engine_read_metrics()
+            metrics = user_values(engine.dispatched_values)
+            assert_equals(
+                sorted((m.type_instance, m.values, m.plugin_instance)
+                       for m in metrics),
+                [("service.errors", [1], "[datacenter=east]"),
+                 ("web.hits", [2], "")])
+            internal = internal_values(engine.dispatched_values)
+            assert_equals(internal["dogstatsd.filtered"], [2])
+        finally:
+            engine.engine_run_shutdowns()
+
+    def test_listeners(self):
+        engine, module = self._start_module(1235, [("Listeners", "2")])
+        try:
+            assert_equals(len(module.servers), 2)
+            for server in module.servers:
+                server.running.wait(2)
+            # Separate source ports get spread across both listeners
+            for _ in range(20):
+                self._send_udp(["page.views:1|c|#country:china"], port=1235)
+
+            deadline = time.time() + 2
+            while time.time() < deadline and sum(
+                    s.metrics_aggregator.count for s in module.servers) < 20:
+                time.sleep(.01)
+
+            self.current_time += dogstatsd.DOGSTATSD_AGGREGATOR_BUCKET_SIZE
+            engine.engine_read_metrics()
+            metrics = user_values(engine.dispatched_values)
+            assert_equals(len(metrics), 1)
+            assert_equals(metrics[0].type_instance, "page.views")
+            assert_equals(metrics[0].values, [20])
+            assert_equals(metrics[0].plugin_instance, "[country=china]")
+        finally:
+            engine.engine_run_shutdowns()
+
+    def test_workers(self):
+        # The workers keep their own copy of the clock, it has to be real
+        aggregator.time = time.time
+        engine, module = self._start_module(1235, [("Workers", "2"),
+                                                   ("Interval", "1")])
+        try:
+            module.server.running.wait(2)
+            pool = module.server.metrics_aggregator
+            processes = list(pool.processes)
+            assert_equals(len(processes), 2)
+            self._send_udp(["page.views:1|c|#country:china",
+                            "page.views:2|c|#country:china",
+                            "fuel.level:0.5|g"], port=1235)
+            self._wait_for_count(3, pool)
+
+            # Wait for the bucket to close, each worker flushes its share
+            totals = {}
+            deadline = time.time() + 5
+            while totals.get("page.views") != 3 or "fuel.level" not in totals:
+                assert time.time() < deadline
+                time.sleep(.2)
+                del engine.dispatched_values[:]
+                engine.engine_read_metrics()
+                for metric in user_values(engine.dispatched_values):
+                    totals[metric.type_instance] = totals.get(
+                        metric.type_instance, 0) + metric.values[0]
+            assert_equals(totals, {"page.views": 3, "fuel.level": 0.5})
+        finally:
+            engine.engine_run_shutdowns()
+        assert not any(p.is_alive() for p in processes)
+
+    def test_queue(self):
+        engine, module = self._start_module(1235, [("QueueSize", "16")])
+        try:
+            module.server.running.wait(2)
+            self._send_udp(["page.views:1|c", "page.views:2|c"], port=1235)
+            self._wait_for_count(2, module.server.metrics_aggregator)
+            assert_equals(module.server.ring.depth, 0)
+            assert_equals(module.server.ring.dropped, 0)
+        finally:
+            engine.engine_run_shutdowns()
+
+    def test_unix_socket(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "dogstatsd.sock")
+        engine, module = self._start_module(None, [("SocketPath", path)])
+        try:
+            module.server.running.wait(2)
+            assert_equals(module.server.socket, None)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.sendto("page.views:1|c\nfuel.level:0.5|g", path)
+            sock.close()
+            self._wait_for_count(2, module.server.metrics_aggregator)
+        finally:
+            engine.engine_run_shutdowns()
+            assert not os.path.exists(path)
+            shutil.rmtree(tmpdir)
+
+    def test_unix_socket_removed(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "dogstatsd.sock")
+        engine, module = self._start_module(None, [("SocketPath", path)])
+        module.server.running.wait(2)
+        os.unlink(path)
+        shutdown = threading.Thread(target=engine.engine_run_shutdowns)
+        shutdown.daemon = True
+        shutdown.start()
+        shutdown.join(5)
+        shutil.rmtree(tmpdir)
+        assert not shutdown.is_alive()
+
+    def test_tcp(self):
+        # pylint: disable=no-member
+        engine, module = self._start_module(None, [("TCPPort", "1236")])
+        try:
+            module.server.running.wait(2)
+            idle = socket.create_connection(("127.0.0.1", 1236))
+            sock = socket.create_connection(("127.0.0.1", 1236))
+            sock.sendall("page.views:1|c|#country:china\npage.vi")
+            time.sleep(.05)
+            sock.sendall("ews:2|c|#country:china\nfuel.level:0.5|g")
+            sock.close()
+            self._wait_for_count(3, module.server.metrics_aggregator)
+            idle.close()
+
+            self.current_time += dogstatsd.DOGSTATSD_AGGREGATOR_BUCKET_SIZE
+            engine.engine_read_metrics()
+            metrics = user_values(engine.dispatched_values)
+            assert_equals(len(metrics), 2)
+            assert_equals(
+                sorted((m.type_instance, m.values) for m in metrics),
+                [("fuel.level", [0.5]), ("page.views", [3])])
+        finally:
+            engine.engine_run_shutdowns()
+
+    def test_receive_buffer(self):
+        engine, module = self._start_module(1235, [("ReceiveBuffer",
+                                                    "65536")])
+        try:
+            module.server.running.wait(2)
+            assert module.server.socket.getsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+            engine.engine_read_metrics()
+            internal = internal_values(engine.dispatched_values)
+            if os.path.exists("/proc/net/udp"):
+                assert_equals(internal["dogstatsd.udp.receive_drops"], [0])
+        finally:
+            engine.engine_run_shutdowns()
+
+    def test_internal_metrics(self):
+        self.dog_module.server.metrics_aggregator.submit_packets(
+            "page.views:1|c\npage.views:bogus|c")
+        self._check_expected([["page.views", [1], "absolute", ""]])
+        internal = internal_values(self.collectd_engine.dispatched_values)
+        assert_equals(internal["dogstatsd.parse_errors"], [1])
+        assert_equals(internal["dogstatsd.contexts[metric_class=Counter]"],
+                      [1])
+        assert "dogstatsd.flush.duration" in internal
+        assert "dogstatsd.receive.latency.max" in internal
+
+    def test_forward(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 1237))
+        receiver.settimeout(2)
+        engine, module = self._start_module(1235, [
+            ("ForwardHost", "127.0.0.1"), ("ForwardPort", "1237")])
+        try:
+            module.server.running.wait(2)
+            self._send_udp(["page.views:1|c"], port=1235)
+            assert_equals(receiver.recv(1024), "page.views:1|c")
+            self._wait_for_count(1, module.server.metrics_aggregator)
+            # Counted once send() has returned, which may be after we got it
+            deadline = time.time() + 2
+            while not module.server.forwarder.sent and time.time() < deadline:
+                time.sleep(.01)
+            engine.engine_read_metrics()
+            internal = internal_values(engine.dispatched_values)
+            assert_equals(internal["dogstatsd.forward.sent"], [1])
+            assert_equals(internal["dogstatsd.forward.dropped"], [0])
+        finally:
+            engine.engine_run_shutdowns()
+            receiver.close()
+
+
+# pylint: disable=too-few-public-methods,no-self-use
+class TestColumnarModuleSetup(TestModuleSetup):
+    """ The same, with a ColumnarAggregator """
+    OPTIONS = [dummy_collectd.Config(key="Columnar", values=[True])]
+
+
+class TestForwarder(object):
+
+    def test_coalesce(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(2)
+        forwarder = dogstatsd.Forwarder("127.0.0.1",
+                                        receiver.getsockname()[1],
+                                        queue_size=2, max_packet_size=20)
+        forwarder.forward(["a:1|c", "b:1|c"])
+        forwarder.forward(["c:1|c", "this.is.a.long:1|c"])
+        forwarder.forward(["dropped:1|c"])
+        forwarder.start()
+        forwarder.stop()
+        assert_equals(receiver.recv(1024), "a:1|c\nb:1|c\nc:1|c")
+        assert_equals(receiver.recv(1024), "this.is.a.long:1|c")
+        receiver.close()
+        stats = dict((name, value) for name, value, _, _ in
+                     forwarder.flush_stats())
+        assert_equals(stats, {"forward.sent": 2, "forward.coalesced": 3,
+                              "forward.dropped": 1})
+
+    def test_dropped(self):
+        # Counted apart on the receiving and the forwarding threads
+        forwarder = dogstatsd.Forwarder("127.0.0.1", 9, queue_size=1)
+        # Too big for a datagram
+        forwarder.forward(["big:1|c" + "0" * 70000])
+        forwarder.forward(["dropped:1|c"])
+        forwarder.start()
+        forwarder.stop()
+        assert_equals((forwarder.dropped, forwarder.send_dropped), (1, 1))
+        stats = dict((name, value) for name, value, _, _ in
+                     forwarder.flush_stats())
+        assert_equals(stats["forward.dropped"], 2)
+
+
+class TestWorkerPool(object):
+
+    @staticmethod
+    def _start(queue_size=dogstatsd.WORKER_QUEUE_SIZE):
+        pool = dogstatsd.WorkerPool(
+            lambda: aggregator.MetricsBucketAggregator(None, 1), 2,
+            queue_size=queue_size, flush_timeout=.5)
+        pool.start()
+        return pool
+
+    @staticmethod
+    def _check_stops_at_once(pool):
+        started = time.time()
+        pool.stop()
+        assert time.time() - started < 2
+
+    def test_dead_worker(self):
+        pool = self._start()
+        try:
+            os.kill(pool.processes[0].pid, signal.SIGKILL)
+            pool.processes[0].join(2)
+            started = time.time()
+            pool.flush()
+            assert time.time() - started < .5
+            assert_equals(pool.alive, [False, True])
+            pool.submit_packets("\n".join("m%d:1|c" % idx
+                                          for idx in range(20)))
+            assert pool.dropped > 0
+            assert_equals(pool.count + pool.dropped, 20)
+        finally:
+            self._check_stops_at_once(pool)
+
+    def test_stalled_worker(self):
+        pool = self._start(queue_size=2)
+        stalled = pool.processes[0]
+        os.kill(stalled.pid, signal.SIGSTOP)
+        try:
+            for idx in range(50):
+                pool.submit_packets("m%d:1|c" % idx)
+            assert pool.dropped > 0
+            started = time.time()
+            pool.flush()
+            assert time.time() - started < 2
+            self._check_stops_at_once(pool)
+        finally:
+            os.kill(stalled.pid, signal.SIGKILL)
+            stalled.join(2)
+
+
+# pylint: disable=too-few-public-methods,no-self-use
+class TestStop(object):
+
+    @staticmethod
+    def _check_stops_at_once(server):
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        server.running.wait(2)
+        started = time.time()
+        server.stop()
+        thread.join(2)
+        assert not thread.is_alive()
+        assert time.time() - started < 1
+
+    def test_udp(self):
+        self._check_stops_at_once(dogstatsd.Server(
+            aggregator.MetricsBucketAggregator(None, 10), "127.0.0.1", 0,
+            timeout=60))
+
+    def test_tcp(self):
+        self._check_stops_at_once(dogstatsd.StreamServer(
+            aggregator.MetricsBucketAggregator(None, 10), "127.0.0.1", 0,
+            timeout=60))
+
+    def test_wake_closed(self):
+        waker = dogstatsd.Waker()
+        fds = (waker.read_fd, waker.write_fd)
+        waker.close()
+        # The fds go to the next files opened
+        read_fd, write_fd = os.pipe()
+        try:
+            assert_equals((read_fd, write_fd), fds)
+            waker.wake()
+            os.write(write_fd, "x")
+            assert_equals(os.read(read_fd, 16), "x")
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+
+class TestPacketRing(object):
+
+    @staticmethod
+    def _fill(ring, count):
+        buf = ring.new_buffer()
+        for idx in range(count):
+            message = "m%d" % idx
+            buf[:len(message)] = message
+            buf = ring.put(buf, len(message))
+
+    def test_drop_newest(self):
+        ring = dogstatsd.PacketRing(3, 16, dogstatsd.DROP_NEWEST)
+        self._fill(ring, 5)
+        assert_equals(ring.dropped, 2)
+        assert_equals(ring.max_depth, 3)
+        assert_equals(ring.get_batch(2), ["m0", "m1"])
+        assert_equals(ring.get_batch(10), ["m2"])
+
+    def test_drop_oldest(self):
+        ring = dogstatsd.PacketRing(3, 16, dogstatsd.DROP_OLDEST)
+        self._fill(ring, 5)
+        assert_equals(ring.dropped, 2)
+        assert_equals(ring.depth, 3)
+        assert_equals(ring.get_batch(10), ["m2", "m3", "m4"])
+
+    def test_close(self):
+        ring = dogstatsd.PacketRing(3, 16)
+        self._fill(ring, 1)
+        ring.close()
+        assert_equals(ring.get_batch(10), ["m0"])
+        assert_equals(ring.get_batch(10), [])
+
+
+class TestParse(object):
+
+    def __init__(self):
+        self.metrics_aggregator = aggregator.MetricsBucketAggregator(None, 10)
+
+    @staticmethod
+    def _parse(parse, packet):
+        try:
+            return parse(packet)
+        except Exception:  # pylint: disable=broad-except
+            return "error"
+
+    def test_fast_path_matches(self):
+        packets = [
+            "page.views:1|c",
+            "page.views:-1|c|@0.5",
+            "fuel.level:0.5|g|#country:china,service:web:1",
+            "fuel.level:1e3|g|@1|#a,b:c",
+            "fuel.level:inf|g",
+            "fuel.level:+5|g",
+            "users.online:123|s|#a:b",
+            "users.online:joe|s",
+            "page.views:1|c:2|c|#a:b",
+            "page.views:1|c|#a:b:2|ms",
+            "page.views:1|c|#a:b|@0.5",
+            "page.views:1|c:2",
+            "page.views:x|c",
+            "page.views:1",
+            "page.views",
+            "page.views:1||#a:b",
+            "page.views:1|c|",
+        ]
+        fast = self.metrics_aggregator.parse_metric_packet
+        general = self.metrics_aggregator.parse_multi_metric_packet
+        for packet in packets:
+            assert_equals(self._parse(fast, packet),
+                          self._parse(general, packet))
+
+    def test_metric_line(self):
+        packets = ("page.views:1|c\n"
+                   "_e{5,4}:title|text\n"
+                   "fuel.level:0.5|g|@0.5|#a:b,c\r\n"
+                   "\n"
+                   "page.views:1|c:2|c\n"
+                   "_private:1|c\n"
+                   "page.views:1|c|@0.5|#a:b,c\n"
+                   "page.views:1|c")
+        assert_equals([m.groups() for m in
+                       aggregator.METRIC_LINE.finditer(packets)], [
+                           ("page.views", "1", "c", None, None),
+                           ("page.views", "1", "c", "0.5", "a:b,c"),
+                           ("page.views", "1", "c", None, None)])
+
+    def test_bulk_matches_lines(self):
+        # pylint: disable=protected-access
+        packets = ("page.views:1|c\n"
+                   "_e{5,4}:title|text\n"
+                   "fuel.level:0.5|g|@0.5|#a:b,c\r\n"
+                   "\n"
+                   "page.views:1|c:2|c\n"
+                   "page.views:x|c\n"
+                   "_private:1|c\n"
+                   "page.views:1|c|@0.5|#c,a:b\n"
+                   "users.online:123|s\n"
+                   "page.views:1|c")
+        results = []
+        for submit in ("submit_packets", "_submit_lines"):
+            metrics_aggregator = aggregator.MetricsBucketAggregator(None, 10)
+            with FakeClock() as clock:
+                if submit == "submit_packets":
+                    metrics_aggregator.submit_packets(packets)
+                else:
+                    metrics_aggregator._submit_lines(packets, False)
+                clock.now = 1010.0
+                results.append((
+                    sorted((m['metric'], m['tags'], m['points'][0][1])
+                           for m in metrics_aggregator.flush()),
+                    metrics_aggregator.parse_errors,
+                    metrics_aggregator.event_count))
+        assert_equals(results[0], results[1])
+        assert_equals(results[0][1:], (1, 1))
+
+    def test_service_check(self):
+        for aggregator_class in (aggregator.MetricsBucketAggregator,
+                                 aggregator.MetricsAggregator):
+            metrics_aggregator = aggregator_class("myhost", 10)
+            metrics_aggregator.submit_packets(
+                "_sc|db.up|0|d:1000|#env:prod|m:ok\n_sc|web.up|2")
+            service_checks = metrics_aggregator.flush_service_checks()
+            assert_equals([(sc["check"], sc["status"], sc["host_name"])
+                           for sc in service_checks],
+                          [("db.up", 0, "myhost"), ("web.up", 2, "myhost")])
+            assert_equals(service_checks[0]["tags"], ["env:prod"])
+            assert_equals(service_checks[0]["message"], "ok")
+            assert_equals(metrics_aggregator.flush_service_checks(), [])
+
+
+class TestContextCache(object):
+
+    @staticmethod
+    def _flush(metrics_aggregator):
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets(
+                "page.views:1|c|#b:2,a:1,host:web1\n"
+                "page.views:2|c|#b:2,a:1,host:web1\n"
+                "page.views:4|c|#a:1,b:2,host:web1\n"
+                "fuel.level:0.5|g\n"
+                "page.views:8|c:16|c")
+            clock.now = 1010.0
+            return sorted((m['metric'], m['tags'], m['host'], m['points'])
+                          for m in metrics_aggregator.flush())
+
+    def test_same_metrics(self):
+        cached = aggregator.MetricsBucketAggregator(None, 10)
+        uncached = aggregator.MetricsBucketAggregator(None, 10,
+                                                      context_cache_size=0)
+        assert_equals(self._flush(cached), self._flush(uncached))
+        assert_equals(cached.context_cache.misses, 3)
+        assert_equals(cached.context_cache.hits, 1)
+
+    def test_utf8(self):
+        packets = ("caf\xc3\xa9:1|c|#pays:\xc3\xa9t\xc3\xa9\n"
+                   "caf\xc3\xa9:2|c|#pays:\xc3\xa9t\xc3\xa9\n"
+                   "fuel.level:0.5|g")
+        flushed = []
+        for cache_size in (0, 16):
+            metrics_aggregator = aggregator.MetricsBucketAggregator(
+                None, 10, utf8_decoding=True, context_cache_size=cache_size)
+            with FakeClock() as clock:
+                metrics_aggregator.submit_packets(packets)
+                clock.now = 1010.0
+                flushed.append(sorted(
+                    (m['metric'], m['tags'], m['points'][0][1])
+                    for m in metrics_aggregator.flush()))
+        assert_equals(flushed[0], [(u"caf\xe9", (u"pays:\xe9t\xe9",), 0.3),
+                                   ("fuel.level", None, 0.5)])
+        assert_equals(flushed[1], flushed[0])
+        # ASCII is not decoded
+        assert isinstance(flushed[1][1][0], str)
+
+    def test_bounded(self):
+        cache = aggregator.ContextCache(4)
+        for key in range(10):
+            cache.put(key, key)
+            # Keep using 0, so that it stays
+            assert_equals(cache.get(0), 0)
+        assert len(cache.young) + len(cache.old) <= 4
+        assert_equals(cache.get(9), 9)
+        assert_equals(cache.get(1), None)
+
+
+class TestCardinalityLimiter(object):
+    AGGREGATOR = aggregator.MetricsBucketAggregator
+
+    @staticmethod
+    def _flush(metrics_aggregator, packets):
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets(packets)
+            clock.now = 1010.0
+            return sorted((m['metric'], m['tags'], m['points'][0][1])
+                          for m in metrics_aggregator.flush())
+
+    def test_per_metric(self):
+        metrics_aggregator = self.AGGREGATOR(
+            None, 1, max_contexts_per_metric=2)
+        packets = "\n".join("page.views:1|c|#request:%d" % idx
+                            for idx in range(5))
+        assert_equals(self._flush(metrics_aggregator, packets), [
+            ("page.views", ("__overflow__:true",), 3),
+            ("page.views", ("request:0",), 1),
+            ("page.views", ("request:1",), 1),
+        ])
+        stats = metrics_aggregator.flush_stats()
+        assert ("cardinality.limited", 3, "count",
+                ("metric:page.views",)) in stats
+
+    def test_global(self):
+        metrics_aggregator = self.AGGREGATOR(
+            None, 1, max_contexts=2)
+        packets = "a:1|c\nb:1|c\nc:1|c\nd:0.5|g\na:1|c"
+        assert_equals(self._flush(metrics_aggregator, packets), [
+            ("__overflow__", ("metric_type:c",), 1),
+            ("__overflow__", ("metric_type:g",), 0.5),
+            ("a", None, 2),
+            ("b", None, 1),
+        ])
+        # The next interval starts from scratch
+        assert_equals(self._flush(metrics_aggregator, "c:1|c")[-1],
+                      ("c", None, 1))
+
+    def test_shard(self):
+        # A shard is only ever merged into another aggregator
+        metrics_aggregator = self.AGGREGATOR(
+            None, 10, max_contexts_per_metric=2)
+        shard = self.AGGREGATOR(None, 10, max_contexts_per_metric=2)
+        with FakeClock() as clock:
+            for ids in (("a", "b"), ("c", "d")):
+                shard.submit_packets("\n".join("x:1|c|#id:%s" % idx
+                                               for idx in ids))
+                clock.now += 10
+                metrics_aggregator.merge_from(shard)
+                # Counters of past intervals report zeros
+                assert_equals(sorted(m['tags'] for m in
+                                     metrics_aggregator.flush()
+                                     if m['points'][0][1]),
+                              [("id:%s" % idx,) for idx in ids])
+
+
+class TestColumnarCardinalityLimiter(TestCardinalityLimiter):
+    AGGREGATOR = aggregator.ColumnarAggregator
+
+
+class TestCounterExpiry(object):
+    AGGREGATOR = aggregator.MetricsBucketAggregator
+
+    def test_zero_fill(self):
+        metrics_aggregator = self.AGGREGATOR(
+            None, 10, expiry_seconds=30)
+
+        def flush(now, packets=""):
+            clock.now = now
+            metrics_aggregator.submit_packets(packets)
+            clock.now = now + 10
+            return sorted((m["metric"], m["points"][0][1])
+                          for m in metrics_aggregator.flush())
+
+        with FakeClock() as clock:
+            assert_equals(flush(1000.0, "hits:20|c\nerrors:10|c"),
+                          [("errors", 1.0), ("hits", 2.0)])
+            assert_equals(flush(1010.0, "hits:10|c"),
+                          [("errors", 0.0), ("hits", 1.0)])
+            # errors expire 30s after their last sample, hits 10s later
+            assert_equals(flush(1020.0), [("errors", 0.0), ("hits", 0.0)])
+            assert_equals(flush(1030.0), [("hits", 0.0)])
+            assert_equals(flush(1040.0), [])
+            assert_equals(metrics_aggregator.counter_expiry_index, [])
+
+    def test_contexts_across_buckets(self):
+        metrics_aggregator = self.AGGREGATOR(None, 10)
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets("hits:1|c\ndepth:1|g")
+            clock.now = 1010.0
+            metrics_aggregator.submit_packets(
+                "hits:1|c\ndepth:2|g\nerrors:1|c")
+            # Both buckets at once
+            clock.now = 1020.0
+            metrics_aggregator.flush()
+        stats = sorted((tags, value) for name, value, _, tags
+                       in metrics_aggregator.flush_stats()
+                       if name == 'contexts')
+        assert_equals(stats, [(("metric_class:BucketGauge",), 1),
+                              (("metric_class:Counter",), 2)])
+
+    def test_contexts_without_traffic(self):
+        metrics_aggregator = self.AGGREGATOR(None, 10)
+
+        def contexts():
+            return [value for name, value, _, _
+                    in metrics_aggregator.flush_stats()
+                    if name == 'contexts']
+
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets("depth:1|g")
+            clock.now = 1010.0
+            metrics_aggregator.flush()
+            assert_equals(contexts(), [1])
+            # Too early for the next bucket
+            metrics_aggregator.flush()
+            assert_equals(contexts(), [1])
+            clock.now = 1020.0
+            metrics_aggregator.flush()
+            assert_equals(contexts(), [0])
+
+
+class TestColumnarCounterExpiry(TestCounterExpiry):
+    AGGREGATOR = aggregator.ColumnarAggregator
+
+    def test_recycle_ids(self):
+        metrics_aggregator = self.AGGREGATOR(None, 10, expiry_seconds=30)
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets("hits:1|c\ndepth:1|g")
+            clock.now = 1050.0
+            metrics_aggregator.flush()
+            # Freed by the listener, before its next batch
+            assert_equals(metrics_aggregator.free_ids, [])
+            metrics_aggregator.submit_packets("users:3|g")
+            assert_equals(metrics_aggregator.free_ids, [0])
+            assert_equals(metrics_aggregator.context_ids.keys(),
+                          [("users", (), None, None)])
+            clock.now = 1060.0
+            assert_equals([(m["metric"], m["points"][0][1])
+                           for m in metrics_aggregator.flush()],
+                          [("users", 3)])
+            assert_equals(len(metrics_aggregator.kinds), 2)
+
+    def test_recycle_shard_ids(self):
+        metrics_aggregator = self.AGGREGATOR(None, 10, expiry_seconds=30)
+        shard = self.AGGREGATOR(None, 10, expiry_seconds=30)
+        with FakeClock() as clock:
+            for interval in range(10):
+                shard.submit_packets("\n".join(
+                    "depth:1|g|#id:%d.%d" % (interval, idx)
+                    for idx in range(10)))
+                # Its own listener recycles the primary's ids
+                metrics_aggregator.submit_packets("")
+                clock.now += 10
+                metrics_aggregator.merge_from(shard)
+                metrics_aggregator.flush()
+        # Series last seen 30s ago, at most, and those of the last interval
+        assert len(shard.kinds) <= 50
+        assert_equals(len(shard.kinds), len(metrics_aggregator.kinds))
+
+
+class TestColumnarGauges(object):
+
+    def test_value_types(self):
+        metrics_aggregator = aggregator.ColumnarAggregator(None, 10)
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets(
+                "users:5|g\nload:0.5|g\nhits:25|c")
+            clock.now = 1010.0
+            metrics = dict((m["metric"], m["points"][0][1])
+                           for m in metrics_aggregator.flush())
+        assert_equals([(metric, type(value))
+                       for metric, value in sorted(metrics.items())],
+                      [("hits", float), ("load", float), ("users", int)])
+        assert_equals(metrics["hits"], 2.5)
+
+
+class TestConcurrentFlush(object):
+    AGGREGATOR = aggregator.MetricsBucketAggregator
+
+    def test_no_sample_lost(self):
+        metrics_aggregator = self.AGGREGATOR(None, .05)
+        packets = "\n".join("hits:1|c|#id:%d\ndepth:1|g|#id:%d" % (idx, idx)
+                            for idx in range(50))
+        batches = [0]
+        done = threading.Event()
+
+        def submit():
+            while not done.is_set():
+                metrics_aggregator.submit_packets(packets)
+                batches[0] += 1
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        metrics = []
+        try:
+            for _ in range(20):
+                time.sleep(.01)
+                metrics += metrics_aggregator.flush()
+        finally:
+            done.set()
+            thread.join()
+        time.sleep(.06)
+        metrics += metrics_aggregator.flush()
+        hits = sum(m["points"][0][1] * .05 for m in metrics
+                   if m["metric"] == "hits")
+        assert_equals(int(round(hits)), batches[0] * 50)
+        assert metrics_aggregator.metric_by_bucket == {}
+
+    def test_stalled_batch(self):
+        metrics_aggregator = self.AGGREGATOR(None, 10)
+        timeout = aggregator.BATCH_WAIT_TIMEOUT
+        aggregator.BATCH_WAIT_TIMEOUT = .01
+        try:
+            with FakeClock() as clock:
+                metrics_aggregator.submit_packets("hits:10|c\ndepth:1|g")
+                # As if the listener was stuck in a batch
+                metrics_aggregator.in_batch = True
+                clock.now = 1010.0
+                assert_equals(metrics_aggregator.flush(), [])
+                metrics_aggregator.in_batch = False
+                assert_equals(sorted((m["metric"], m["points"][0][1])
+                                     for m in metrics_aggregator.flush()),
+                              [("depth", 1), ("hits", 1.0)])
+        finally:
+            aggregator.BATCH_WAIT_TIMEOUT = timeout
+
+
+class TestColumnarConcurrentFlush(TestConcurrentFlush):
+    AGGREGATOR = aggregator.ColumnarAggregator
+
+
+class TestLoadShedder(object):
+
+    def test_shed(self):
+        metrics_aggregator = aggregator.MetricsBucketAggregator(None, 1)
+        shedder = dogstatsd.LoadShedder(metrics_aggregator, 0.25)
+        shedder.update(0.9)
+        # Stays on until the load is back under the low watermark
+        shedder.update(0.6)
+        assert_equals(metrics_aggregator.shed_sample_rate, 0.25)
+        aggregator.random.seed(42)
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets(
+                "\n".join(["latency:10|ms", "hits:1|c", "depth:3|g"] * 4000))
+            clock.now = 1010.0
+            metrics = dict((m['metric'], m['points'][0][1])
+                           for m in metrics_aggregator.flush())
+        assert_equals(metrics['hits'], 4000)
+        assert_equals(metrics['depth'], 3)
+        assert abs(metrics['latency.count'] - 4000) < 400
+        stats = dict((s[0], s[1]) for s in metrics_aggregator.flush_stats())
+        assert 2700 < stats['shed'] < 3300
+        assert_equals(stats['shed_sample_rate'], 0.25)
+        shedder.update(0.4)
+        assert_equals(metrics_aggregator.shed_sample_rate, 1)
+
+    def test_shed_multi_value(self):
+        # Off the single value fast path
+        metrics_aggregator = aggregator.MetricsBucketAggregator(None, 1)
+        metrics_aggregator.shed_sample_rate = 0.25
+        aggregator.random.seed(42)
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets(
+                "\n".join(["latency:10|ms:20|ms", "hits:1|c:2|c"] * 2000))
+            clock.now = 1010.0
+            metrics = dict((m['metric'], m['points'][0][1])
+                           for m in metrics_aggregator.flush())
+        assert_equals(metrics['hits'], 6000)
+        assert abs(metrics['latency.count'] - 4000) < 400
+        assert 2700 < metrics_aggregator.shed < 3300
+
+
+class TestDistribution(object):
+
+    def test_quantiles(self):
+        values = [random.lognormvariate(3, 1) for _ in range(10000)]
+        values += [-v for v in values[:100]] + [0] * 50
+        exact = sorted(values)
+        sketch = aggregator.QuantileSketch()
+        for value in values[:5000]:
+            sketch.add(value)
+        other = aggregator.QuantileSketch()
+        for value in values[5000:]:
+            other.add(value)
+        sketch.merge(other)
+        assert_equals(sketch.count, len(values))
+        assert_equals((sketch.min, sketch.max), (exact[0], exact[-1]))
+        for quantile in (0, 0.01, 0.5, 0.99, 0.999, 1):
+            expected = exact[int(quantile * (len(exact) - 1))]
+            assert abs(sketch.quantile(quantile) - expected) <= \
+                abs(expected) * aggregator.SKETCH_RELATIVE_ACCURACY + 1e-9
+
+    def test_bounded(self):
+        sketch = aggregator.QuantileSketch(max_bins=64)
+        for idx in range(1, 10000):
+            sketch.add(1.1 ** (idx % 500))
+        assert len(sketch.positive) <= 64
+        # The lowest bins were collapsed, the highest are still accurate
+        assert abs(sketch.quantile(1) / 1.1 ** 499 - 1) <= \
+            aggregator.SKETCH_RELATIVE_ACCURACY
+
+    def test_flush(self):
+        metrics_aggregator = aggregator.MetricsBucketAggregator(None, 1)
+        with FakeClock() as clock:
+            metrics_aggregator.submit_packets(
+                "\n".join("latency:%d|d|#shard:%d" % (idx, idx % 2)
+                          for idx in range(1, 1001)))
+            clock.now = 1010.0
+            metrics = sorted((m['metric'], m['tags'], m['points'][0][1])
+                             for m in metrics_aggregator.flush())
+        shard = [m[::2] for m in metrics if m[1] == ("shard:1",)]
+        assert_equals([m[0] for m in shard], [
+            "latency.50percentile", "latency.99_9percentile",
+            "latency.99percentile", "latency.avg", "latency.count",
+            "latency.max", "latency.min"])
+        assert_equals(dict(shard)["latency.count"], 500)
+        assert_equals(dict(shard)["latency.max"], 999)
+        assert abs(dict(shard)["latency.50percentile"] - 499) < 5
+
+
+class TestMetric(object):
+
+    def test_compact(self):
+        context = ("page.views", ("env:prod",), "host1", None)
+        for metric_class in (aggregator.BucketGauge, aggregator.Counter,
+                             aggregator.Histogram, aggregator.Set):
+            metric = metric_class(aggregator.api_formatter, context)
+            assert not hasattr(metric, "__dict__")
+            metric.sample(1, 1)
+            flushed = metric.flush(1000, 10)[0]
+            assert_equals((flushed["tags"], flushed["host"]),
+                          (("env:prod",), "host1"))
+
+    def test_histogram(self):
+        context = ("latency", (), None, None)
+        percentiles = [0.01, 0.5, 0.95, 0.99]
+        for length in (1, 2, 3, 10, 101):
+            histogram = aggregator.Histogram(
+                aggregator.api_formatter, context,
+                {"aggregates": ["min", "max", "median", "avg"],
+                 "percentiles": percentiles})
+            values = [random.randint(-1000, 1000) for _ in range(length)]
+            for value in values:
+                histogram.sample(value, 1)
+            flushed = dict((m["metric"], m["points"][0][1])
+                           for m in histogram.flush(1000, 10))
+            # What sorting every sample gives
+            values.sort()
+            expected = {
+                "latency.min": values[0],
+                "latency.max": values[-1],
+                "latency.median": values[int(round(length / 2 - 1))],
+                "latency.avg": sum(values) / float(length),
+            }
+            for percentile in percentiles:
+                expected["latency.%dpercentile" % int(percentile * 100)] = \
+                    values[int(round(percentile * length - 1))]
+            assert_equals(flushed, expected)
+            # As sampled without NumPy, Python floats with it
+            assert_equals(set(type(flushed[name]) for name in expected
+                              if name != "latency.avg"),
+                          set([float if aggregator.numpy else int]))
+
+
+class TestSketchHistogram(object):
+
+    def test_error_bound(self):
+        context = ("latency", (), None, None)
+        exact = aggregator.Histogram(aggregator.api_formatter, context)
+        sketch = aggregator.SketchHistogram(aggregator.api_formatter, context)
+        values = [random.lognormvariate(3, 1) for _ in range(20000)]
+        for value in values:
+            exact.sample(value, 0.5)
+            sketch.sample(value, 0.5)
+        expected = dict((m["metric"], m["points"][0][1])
+                        for m in exact.flush(1000, 10))
+        estimated = dict((m["metric"], m["points"][0][1])
+                         for m in sketch.flush(1000, 10))
+        assert_equals(sorted(estimated), sorted(expected))
+        for name in ("latency.max", "latency.count"):
+            assert_equals(estimated[name], expected[name])
+        assert abs(estimated["latency.avg"] - expected["latency.avg"]) < 1e-6
+        values.sort()
+        accuracy = aggregator.SKETCH_RELATIVE_ACCURACY
+        for name, rank in (("latency.median", 0.5),
+                           ("latency.95percentile", 0.95)):
+            # Within the accuracy of the exact value, give or take a rank
+            index = int(rank * len(values))
+            assert values[index - 2] * (1 - accuracy) <= estimated[name] <= \
+                values[index + 1] * (1 + accuracy)
+
+    def test_patterns(self):
+        metrics_aggregator = aggregator.MetricsBucketAggregator(
+            None, 1, sketch_histograms=["api.*"])
+        metrics_aggregator.submit_packets("api.latency:1|ms\ndb.latency:1|h")
+        classes = sorted(metric.__class__.__name__
+                         for metric in metrics_aggregator.current_mbc.values())
+        assert_equals(classes, ["Histogram", "SketchHistogram"])
+
+
+class TestApproximateSet(object):
+
+    def test_estimate(self):
+        context = ("users", (), None, None)
+        for count in (10, 1000, 50000):
+            first = aggregator.ApproximateSet(aggregator.api_formatter,
+                                              context)
+            second = aggregator.ApproximateSet(aggregator.api_formatter,
+                                               context)
+            for idx in range(count):
+                first.sample("user%d" % idx, 1)
+                second.sample(u"user%d" % (idx + count / 2), 1)
+            first.merge(second)
+            flushed = first.flush(1000, 10)
+            assert_equals(len(flushed), 1)
+            assert_equals(flushed[0]["type"], "gauge")
+            # 3 standard errors for the default precision of 12
+            union = count + count / 2
+            assert abs(flushed[0]["points"][0][1] - union) <= union * 0.05
+            assert_equals(first.flush(1010, 10), [])
+
+    def test_patterns(self):
+        metrics_aggregator = aggregator.MetricsBucketAggregator(
+            None, 1, approximate_sets=["unique.*"], set_precision=8)
+        metrics_aggregator.submit_packets(
+            "unique.users:alice|s\nunique.users:bob|s\nunique.users:bob|s\n"
+            "users:alice|s")
+        metrics = dict((context[0], metric) for context, metric
+                       in metrics_aggregator.current_mbc.items())
+        assert_equals(len(metrics["unique.users"].registers), 256)
+        assert_equals(metrics["unique.users"].estimate(), 2)
+        assert isinstance(metrics["users"], aggregator.Set)